@@ -0,0 +1,159 @@
+#  -*- coding: utf-8 -*-
+"""
+Benchmark of the RedshiftClient load and upsert paths, run offline against moto S3
+and the sqlite stand-in of tests/redshift_standin.py:
+
+    python -m benchmarks.redshift_load --sizes 1000 10000 100000 --repeat 3
+
+Times are the lowest of the repeats, summed over the calls of each stage. The ddl, copy, delete and insert
+times measure the client and the local engine, not a cluster, and are meant for comparing changes of the client,
+while statement and round trip counts are those a cluster would receive.
+"""
+__author__ = 'fpajot'
+
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import time
+
+STAGES = ['serialize', 'upload', 'ddl', 'copy', 'delete', 'insert', 'other']
+SCENARIOS = ['load', 'upsert']
+BUCKET = 'pandas-aws-benchmark'
+REGION = 'eu-west-1'
+
+
+class StageTimer(object):
+    """Sums the duration of the calls of wrapped functions by stage"""
+
+    def __init__(self):
+        self.durations = Counter()
+
+    @contextmanager
+    def wrap(self, obj, name: str, stage: str):
+        func = getattr(obj, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.durations[stage] += time.perf_counter() - start
+
+        setattr(obj, name, timed)
+        try:
+            yield
+        finally:
+            setattr(obj, name, func)
+
+
+def make_df(rows: int, seed: int = 0) -> 'pandas.DataFrame':
+    """Builds a DataFrame of integer, float, string and datetime columns"""
+    import numpy
+    import pandas
+
+    random = numpy.random.default_rng(seed)
+    return pandas.DataFrame({
+        'id': numpy.arange(rows),
+        'amount': random.normal(100, 20, rows),
+        'quantity': random.integers(0, 1000, rows),
+        'label': random.choice(['alpha', 'beta', 'gamma', 'delta'], rows),
+        'created_at': pandas.Timestamp('2020-01-01') + pandas.to_timedelta(random.integers(0, 10 ** 7, rows), 's'),
+    })
+
+
+def run(scenario: str, rows: int, s3_client, latency: float = 0.) -> dict:
+    """Runs a scenario once on a new stand-in database, returning its stage times and statement counts"""
+    import pandas_aws.s3
+    from pandas_aws.redshift import RedshiftClient
+    from tests.redshift_standin import StandInConnector
+
+    connector = StandInConnector(s3_client, latency=latency)
+    client = RedshiftClient(connector, 'bench', s3_client=s3_client)
+    df = make_df(rows)
+    if scenario == 'upsert':
+        # half of the rows are updated, the other half inserted
+        client.upload_to_redshift(df, 'events', BUCKET, 'staging', 'role')
+        df = make_df(rows, seed=1).assign(id=lambda d: d['id'] + rows // 2)
+        connector.reset_stats()
+
+    timer = StageTimer()
+    start = time.perf_counter()
+    with timer.wrap(pandas_aws.s3, '_get_splited_df_streams', 'serialize'), \
+            timer.wrap(pandas_aws.s3, '_compress', 'serialize'), \
+            timer.wrap(s3_client, 'put_object', 'upload'):
+        if scenario == 'load':
+            client.upload_to_redshift(df, 'events', BUCKET, 'staging', 'role')
+        else:
+            client.upsert_rows(df, 'events', BUCKET, 'staging', ['id'], 'role')
+    total = time.perf_counter() - start
+    connector.close()
+
+    durations = dict(timer.durations)
+    for kind, duration in connector.durations.items():
+        stage = kind if kind in STAGES else 'other'
+        durations[stage] = durations.get(stage, 0.) + duration
+    return {'scenario': scenario,
+            'rows': rows,
+            'durations': {s: durations.get(s, 0.) for s in STAGES},
+            'total': total,
+            'statements': dict(connector.counts),
+            'round_trips': connector.round_trips,
+            'commits': connector.commits}
+
+
+def benchmark(sizes: list, scenarios: list = None, repeat: int = 3, latency: float = 0.) -> list:
+    """Runs the scenarios for each DataFrame size against moto S3, keeping the lowest times of the repeats"""
+    import boto3
+    from moto import mock_s3
+
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        os.environ.setdefault(name, 'benchmark')
+    results = []
+    with mock_s3():
+        s3_client = boto3.client('s3', region_name=REGION)
+        s3_client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': REGION})
+        for scenario in scenarios or SCENARIOS:
+            for rows in sizes:
+                runs = [run(scenario, rows, s3_client, latency) for _ in range(repeat)]
+                result = min(runs, key=lambda r: r['total'])
+                result['durations'] = {s: min(r['durations'][s] for r in runs) for s in STAGES}
+                results.append(result)
+    return results
+
+
+def format_results(results: list) -> str:
+    """Formats benchmark results as a text table, times in milliseconds"""
+    header = ['scenario', 'rows'] + STAGES + ['total', 'statements', 'round_trips']
+    lines = [header]
+    for r in results:
+        lines.append([r['scenario'], str(r['rows'])]
+                     + [f"{r['durations'][s] * 1000:.1f}" for s in STAGES]
+                     + [f"{r['total'] * 1000:.1f}", str(sum(r['statements'].values())), str(r['round_trips'])])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return '\n'.join('  '.join(v.rjust(w) for v, w in zip(line, widths)) for line in lines)
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the RedshiftClient load and upsert paths offline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of DataFrame rows')
+    parser.add_argument('--scenarios', choices=SCENARIOS, nargs='+', default=SCENARIOS)
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each scenario and size')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='delay in seconds added to each statement round trip')
+    parser.add_argument('--json', help='file path the results are also written to, as JSON')
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.sizes, args.scenarios, args.repeat, args.latency)
+    print(format_results(results))
+    for r in results:
+        print(f"{r['scenario']} {r['rows']}: {json.dumps(r['statements'], sort_keys=True)}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
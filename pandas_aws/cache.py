@@ -0,0 +1,194 @@
+#  -*- coding: utf-8 -*-
+__author__ = 'fpajot'
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# SQL string literals and quoted identifiers, quotes being escaped by doubling them
+_QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+class ResultCache(object):
+    """
+    Cache of query results, made of an in-memory LRU tier and an optional on-disk parquet tier.
+    Entries expire after a time to live, and can be invalidated by query or by dependency table.
+    """
+
+    def __init__(self,
+                 maxsize: int = 128,
+                 ttl: float = 3600,
+                 cache_dir: str = None):
+        """
+        :param maxsize: maximum number of results kept in memory
+        :param ttl: time to live of the results, in seconds, None for no expiration
+        :param cache_dir: directory of the on-disk tier, results are only kept in memory if None
+        """
+        assert maxsize > 0, 'Cache size not accepted, it must be > 0'
+        assert ttl is None or ttl > 0, 'Time to live not accepted, it must be > 0'
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        # key to (expiration time, dependency tables, result)
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Normalizes a query text, collapsing whitespaces outside quoted strings and removing the trailing semicolon"""
+        # quoted literals and identifiers are the odd parts, kept as is
+        parts = _QUOTED.split(query)
+        parts[::2] = [re.sub(r'\s+', ' ', p) for p in parts[::2]]
+        return ''.join(parts).strip().rstrip(';').strip()
+
+    @staticmethod
+    def _normalize_table(table: str) -> str:
+        return table.strip().lower()
+
+    @classmethod
+    def _tables_match(cls, table: str, other: str) -> bool:
+        """Checks whether two table names designate the same table, one of them being possibly unqualified"""
+        if table == other:
+            return True
+        return '.' in table and '.' not in other and table.split('.', 1)[1] == other or \
+            '.' in other and '.' not in table and other.split('.', 1)[1] == table
+
+    def key(self, query: str, **kwargs) -> str:
+        """Computes the cache key of a query, kwargs being other parameters changing its result"""
+        text = json.dumps([self.normalize_query(query), kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.{extension}')
+
+    def get(self, key: str):
+        """
+        Retrieves a cached result
+        :param key: cache key of the query
+        :return: cached DataFrame, or pyarrow.Table, None if missing or expired
+        """
+        import pandas
+        import pyarrow.parquet
+
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                expires_at, _, result = self._entries[key]
+                if expires_at is None or expires_at > now:
+                    self._entries.move_to_end(key)
+                    # cached DataFrames are protected against in place changes
+                    return result.copy() if isinstance(result, pandas.DataFrame) else result
+                del self._entries[key]
+
+            if self.cache_dir is None or not os.path.exists(self._path(key, 'json')):
+                return None
+            try:
+                with open(self._path(key, 'json')) as f:
+                    metadata = json.load(f)
+                if metadata['expires_at'] is not None and metadata['expires_at'] <= now:
+                    self._remove_file(key)
+                    return None
+                result = pyarrow.parquet.read_table(self._path(key, 'parquet'))
+                if metadata['output'] == 'pandas':
+                    result = result.to_pandas()
+            except (OSError, ValueError, KeyError, pyarrow.ArrowException) as e:
+                logger.warning(f'Invalid cache entry {key}: {e}')
+                self._remove_file(key)
+                return None
+            self._set_memory(key, result, metadata['expires_at'], frozenset(metadata['tables']))
+            return result.copy() if isinstance(result, pandas.DataFrame) else result
+
+    def set(self, key: str, result, tables: list = None) -> None:
+        """
+        Caches a result
+        :param key: cache key of the query
+        :param result: DataFrame, or pyarrow.Table, to cache
+        :param tables: tables the result depends on, used for invalidation
+        """
+        import pandas
+
+        expires_at = None if self.ttl is None else time.time() + self.ttl
+        tables = frozenset(self._normalize_table(t) for t in tables or [])
+        with self._lock:
+            if isinstance(result, pandas.DataFrame):
+                result = result.copy()
+            self._set_memory(key, result, expires_at, tables)
+            if self.cache_dir is not None:
+                self._set_file(key, result, expires_at, tables)
+
+    def _set_memory(self, key: str, result, expires_at: float, tables: frozenset) -> None:
+        self._entries[key] = (expires_at, tables, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _set_file(self, key: str, result, expires_at: float, tables: frozenset) -> None:
+        import pandas
+        import pyarrow.parquet
+
+        try:
+            if isinstance(result, pandas.DataFrame):
+                result.to_parquet(self._path(key, 'parquet'), engine='pyarrow')
+                output = 'pandas'
+            else:
+                pyarrow.parquet.write_table(result, self._path(key, 'parquet'))
+                output = 'arrow'
+            # metadata is written last, so that only complete entries are read
+            with open(self._path(key, 'json'), 'w') as f:
+                json.dump({'expires_at': expires_at, 'tables': sorted(tables), 'output': output}, f)
+        except (OSError, ValueError, pyarrow.ArrowException) as e:
+            logger.warning(f'Result not cached on disk: {e}')
+            self._remove_file(key)
+
+    def _remove_file(self, key: str) -> None:
+        for extension in ['json', 'parquet']:
+            try:
+                os.remove(self._path(key, extension))
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, key: str = None, table: str = None) -> None:
+        """
+        Invalidates cached results, all of them if neither key nor table are provided
+        :param key: cache key of the query to invalidate
+        :param table: table name, results depending on it are invalidated
+        """
+        with self._lock:
+            if key is not None:
+                self._entries.pop(key, None)
+                if self.cache_dir is not None:
+                    self._remove_file(key)
+            if table is not None:
+                table = self._normalize_table(table)
+                for k in [k for k, (_, tables, _) in self._entries.items()
+                          if any(self._tables_match(table, t) for t in tables)]:
+                    del self._entries[k]
+                if self.cache_dir is not None:
+                    for file_name in os.listdir(self.cache_dir):
+                        if not file_name.endswith('.json'):
+                            continue
+                        k = file_name[:-len('.json')]
+                        try:
+                            with open(self._path(k, 'json')) as f:
+                                tables = json.load(f)['tables']
+                        except (OSError, ValueError, KeyError):
+                            tables = [table]
+                        if any(self._tables_match(table, t) for t in tables):
+                            self._remove_file(k)
+            if key is None and table is None:
+                self._entries.clear()
+                if self.cache_dir is not None:
+                    for file_name in os.listdir(self.cache_dir):
+                        if file_name.endswith('.json') or file_name.endswith('.parquet'):
+                            self._remove_file(file_name.rsplit('.', 1)[0])
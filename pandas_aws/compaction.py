@@ -0,0 +1,173 @@
+#  -*- coding: utf-8 -*-
+__author__ = 'fpajot'
+
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+
+from . import get_client
+from .s3 import get_keys, get_df, put_df, put_manifest, _unify_arrow_schemas, _unify_arrow_tables, \
+    _concat_arrow_to_df, DOWNLOAD_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+COMPACTION_FORMATS = ['parquet', 'csv']
+SOURCE_FORMATS = ['csv', 'parquet', 'pickle', 'xlsx', 'feather']
+# key suffixes of compressed files, preceded by the file format suffix
+COMPRESSION_SUFFIXES = ['gz', 'zst', 'lz4', 'snappy']
+
+
+def compact(s3: 'boto3.resources.base.ServiceResource',
+            bucket: str,
+            src_prefix: str,
+            dst_prefix: str,
+            target_size_mb: float = 128,
+            format: str = 'parquet',
+            **kwargs):
+    """
+    Rewrite the many small files of an S3 prefix into fewer files of about the target size
+    :param s3: S3 client
+    :param bucket: bucket name of the source and target files
+    :param src_prefix: aws key prefix of the source files
+    :param dst_prefix: aws key prefix of the compacted files, written as {dst_prefix}/part-00001.parquet, ...
+    :param target_size_mb: target size in megabytes of each compacted file
+    :param format: file format of the compacted files, parquet or csv
+    :param suffix: suffix to match when looking for source files
+    :param src_format: file format of the source files, by default it is read from each key suffix,
+        or detected from the file content for keys without a known format suffix
+    :param sort_keys: list of column names each compacted file is sorted by
+    :param compression: compression of the compacted files, snappy for parquet and none for csv by default
+    :param manifest: write a Redshift manifest listing the compacted files at {dst_prefix}.manifest
+    :param concurrency: maximum number of source files downloaded at the same time
+    :param '**kwargs': used for passing arguments to get_df and put_df, i.e scheduler or timeout
+    :return: keys of the compacted files
+    :rtype: list
+    """
+    import pyarrow
+
+    assert format in COMPACTION_FORMATS, 'provider format value not accepted'
+    assert target_size_mb > 0, 'Target size not accepted, it must be > 0'
+
+    suffix = kwargs.pop('suffix', '')
+    src_format = kwargs.pop('src_format', None)
+    sort_keys = kwargs.pop('sort_keys', None)
+    compression = kwargs.pop('compression', 'snappy' if format == 'parquet' else None)
+    manifest = kwargs.pop('manifest', False)
+    concurrency = kwargs.pop('concurrency', DOWNLOAD_CONCURRENCY)
+    assert concurrency > 0, 'Concurrency not accepted, it must be > 0'
+
+    src_keys = [k for k in get_keys(s3, bucket, prefix=src_prefix, suffix=suffix) if k != src_prefix]
+    logger.info(f'Compacting {len(src_keys)} files from {src_prefix} to {dst_prefix}')
+
+    target_size = target_size_mb * 1024 ** 2
+    extension = format + ('.gz' if format == 'csv' and compression == 'gzip' else '')
+    dst_keys = []
+    tables = []
+    tables_size = 0
+    # ratio between the size of a written file and the in-memory size of its data,
+    # updated from each written file
+    size_ratio = 1.
+
+    def read(key):
+        suffixes = key.split('.')
+        if len(suffixes) > 2 and suffixes[-1] in COMPRESSION_SUFFIXES:
+            suffixes.pop()
+        # keys without a known format suffix, i.e part-00000, are read with format detection
+        format_ = src_format or (suffixes[-1] if suffixes[-1] in SOURCE_FORMATS else None)
+        return get_df(s3, bucket, key, format_, output='arrow', **kwargs)
+
+    def write():
+        nonlocal tables_size, size_ratio
+        df = _concat_arrow_to_df(_unify_arrow_tables(tables, schema))
+        key = f"{dst_prefix.rstrip('/')}/part-{len(dst_keys) + 1:05d}.{extension}"
+        put_kwargs = dict(kwargs, format=format, compression=compression)
+        if format == 'parquet':
+            # types must not be inferred again from the pandas columns of each file
+            put_kwargs['schema'] = schema
+        else:
+            # integer columns with nulls are written as integers, not floats
+            for field in schema:
+                if pyarrow.types.is_integer(field.type):
+                    df[field.name] = df[field.name].astype('Int64')
+        if sort_keys:
+            put_kwargs['sort_keys'] = sort_keys
+        put_df(s3, df, bucket, key, **put_kwargs)
+        size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+        size_ratio = size / tables_size if tables_size > 0 else size_ratio
+        logger.info(f'Compacted file {key} written, {size} bytes for {len(df)} rows')
+        dst_keys.append(key)
+        tables_size = 0
+
+    # all the compacted files share the schema unified over the source files, i.e for a Redshift manifest,
+    # thus source files are read a first time for their schema only
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        schema = _unify_arrow_schemas(list(executor.map(lambda k: read(k).schema, src_keys)))
+
+    # source files are downloaded concurrently, but at most concurrency files ahead of the writes
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        remaining_keys = iter(src_keys)
+        futures = deque(executor.submit(read, key) for key in itertools.islice(remaining_keys, concurrency))
+        while futures:
+            table = futures.popleft().result()
+            key = next(remaining_keys, None)
+            if key is not None:
+                futures.append(executor.submit(read, key))
+            tables.append(table)
+            tables_size += table.nbytes
+            if tables_size * size_ratio >= target_size:
+                write()
+        if tables:
+            write()
+
+    if manifest:
+        put_manifest(s3, bucket, f"{dst_prefix.rstrip('/')}.manifest", dst_keys)
+    return dst_keys
+
+
+def main(argv: list = None) -> None:
+    """Console entry point of compact"""
+    parser = argparse.ArgumentParser(prog='pandas-aws-compact',
+                                     description='Compact the small files of an S3 prefix into fewer larger files')
+    parser.add_argument('bucket', help='bucket name of the source and target files')
+    parser.add_argument('src_prefix', help='aws key prefix of the source files')
+    parser.add_argument('dst_prefix', help='aws key prefix of the compacted files')
+    parser.add_argument('--target-size-mb', type=float, default=128, help='target size of each compacted file')
+    parser.add_argument('--format', choices=COMPACTION_FORMATS, default='parquet',
+                        help='file format of the compacted files')
+    parser.add_argument('--suffix', default='', help='suffix to match when looking for source files')
+    parser.add_argument('--src-format', choices=SOURCE_FORMATS,
+                        help='file format of the source files, read from each key suffix or detected by default')
+    parser.add_argument('--sort-keys', help='comma separated column names each compacted file is sorted by')
+    parser.add_argument('--compression', help='compression of the compacted files')
+    parser.add_argument('--manifest', action='store_true', help='write a Redshift manifest of the compacted files')
+    parser.add_argument('--concurrency', type=int, default=DOWNLOAD_CONCURRENCY,
+                        help='maximum number of source files downloaded at the same time')
+    parser.add_argument('--profile', default='default', help='AWS profile name')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    kwargs = {}
+    if args.compression is not None:
+        kwargs['compression'] = args.compression
+    if args.sort_keys:
+        kwargs['sort_keys'] = args.sort_keys.split(',')
+
+    keys = compact(get_client('s3', profile_name=args.profile),
+                   args.bucket,
+                   args.src_prefix,
+                   args.dst_prefix,
+                   target_size_mb=args.target_size_mb,
+                   format=args.format,
+                   suffix=args.suffix,
+                   src_format=args.src_format,
+                   manifest=args.manifest,
+                   concurrency=args.concurrency,
+                   **kwargs)
+    for key in keys:
+        print(f's3://{args.bucket}/{key}')
+
+
+if __name__ == '__main__':
+    main()
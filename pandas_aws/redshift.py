@@ -1,36 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 import datetime
 import logging
 import os
+import threading
+import time
 import traceback
 import sys
-
-import boto3
-import botocore
-import psycopg2
-import pandas
+import uuid
+import weakref
 
 from . import get_client
-from .s3 import put_df
+from .cache import ResultCache
+from .s3 import put_df, put_manifest, _unify_arrow_tables, _compact_df
 
 logger = logging.getLogger()
 
+# connection to the names of the staging tables known to exist in its session, shared by the clients of the connection
+_session_staging_tables = weakref.WeakKeyDictionary()
+_session_staging_tables_lock = threading.Lock()
+
+# lower case Redshift reserved words, which can't be used as column names
+RESERVED_WORDS = frozenset(w.strip().lower() for w in [
+    'AES128', 'AES256', 'ALL', 'ALLOWOVERWRITE',
+    'ANALYSE', 'ANALYZE', 'AND', 'ANY', 'ARRAY',
+    'AS', 'ASC', 'AUTHORIZATION', 'BACKUP', 'BETWEEN',
+    'BINARY', 'BLANKSASNULL', 'BOTH', 'BYTEDICT', 'BZIP2',
+    'CASE', 'CAST', 'CHECK', 'COLLATE', 'COLUMN', 'CONSTRAINT',
+    'CREATE', 'CREDENTIALS', 'CROSS', 'CURRENT_DATE',
+    'CURRENT_TIME', 'CURRENT_TIMESTAMP', 'CURRENT_USER',
+    'CURRENT_USER_ID', 'DEFAULT', 'DEFERRABLE', 'DEFLATE',
+    'DEFRAG', 'DELTA', 'DELTA32K', 'DESC', 'DISABLE',
+    'DISTINCT', 'DO', 'ELSE', 'EMPTYASNULL', 'ENABLE',
+    'ENCODE', 'ENCRYPT', 'ENCRYPTION', 'END', 'EXCEPT',
+    'EXPLICIT', 'FALSE', 'FOR', 'FOREIGN', 'FREEZE', 'FROM',
+    'FULL', 'GLOBALDICT256', 'GLOBALDICT64K', 'GRANT', 'GROUP',
+    'GZIP', 'HAVING', 'IDENTITY', 'IGNORE', 'ILIKE', 'IN',
+    'INITIALLY', 'INNER', 'INTERSECT', 'INTO', 'IS', 'ISNULL',
+    'JOIN', 'LEADING', 'LEFT', 'LIKE', 'LIMIT', 'LOCALTIME',
+    'LOCALTIMESTAMP', 'LUN', 'LUNS', 'LZO', 'LZOP', 'MINUS',
+    'MOSTLY13', 'MOSTLY32', 'MOSTLY8', 'NATURAL', 'NEW', 'NOT',
+    'NOTNULL', 'NULL', 'NULLS', 'OFF', 'OFFLINE', 'OFFSET',
+    'OID', 'OLD', 'ON', 'ONLY', 'OPEN', 'OR', 'ORDER', 'OUTER',
+    'OVERLAPS', 'PARALLEL', 'PARTITION', 'PERCENT', 'PERMISSIONS',
+    'PLACING', 'PRIMARY', 'RAW', 'READRATIO', 'RECOVER',
+    'REFERENCES', 'RESPECT', 'REJECTLOG', 'RESORT', 'RESTORE',
+    'RIGHT', 'SELECT', 'SESSION_USER', 'SIMILAR', 'SNAPSHOT ',
+    'SOME', 'SYSDATE', 'SYSTEM', 'TABLE', 'TAG', 'TDES',
+    'TEXT255', 'TEXT32K', 'THEN', 'TIMESTAMP', 'TO', 'TOP',
+    'TRAILING', 'TRUE', 'TRUNCATECOLUMNS', 'UNION', 'UNIQUE',
+    'USER', 'USING', 'VERBOSE', 'WALLET', 'WHEN', 'WHERE',
+    'WITH', 'WITHOUT'])
+
+
 class RedshiftClient(object):
 
     def __init__(
                 self,
                 pg_connector,
                 schema: str,
-                s3_client: boto3.resources.base.ServiceResource = None,
+                s3_client: 'boto3.resources.base.ServiceResource' = None,
                 profile_name: str = 'default',
+                result_cache: ResultCache = None,
                 **kwargs
                 ):
 
         self.schema = schema
         self.profile_name = profile_name
         self.connector = pg_connector
+        # opt-in cache of get_df results, invalidated by the client writes
+        self.result_cache = result_cache
 
         if s3_client is not None:
-            if isinstance(s3_client, boto3.resources.base.ServiceResource):
+            import boto3
+            import botocore.client
+            if isinstance(s3_client, (boto3.resources.base.ServiceResource, botocore.client.BaseClient)):
                 self.s3_client = s3_client
             else:
                 raise TypeError("expected s3_client of type botocore.client.S3")
@@ -40,35 +83,15 @@ class RedshiftClient(object):
         logger.info("Connected to Redshift")
 
         self.cursor = self.connector.cursor()
-        self._reserved_words = ['AES128', 'AES256', 'ALL', 'ALLOWOVERWRITE',
-                                'ANALYSE', 'ANALYZE', 'AND', 'ANY', 'ARRAY',
-                                'AS', 'ASC', 'AUTHORIZATION', 'BACKUP', 'BETWEEN',
-                                'BINARY', 'BLANKSASNULL', 'BOTH', 'BYTEDICT', 'BZIP2',
-                                'CASE', 'CAST', 'CHECK', 'COLLATE', 'COLUMN', 'CONSTRAINT',
-                                'CREATE', 'CREDENTIALS', 'CROSS', 'CURRENT_DATE',
-                                'CURRENT_TIME', 'CURRENT_TIMESTAMP', 'CURRENT_USER',
-                                'CURRENT_USER_ID', 'DEFAULT', 'DEFERRABLE', 'DEFLATE',
-                                'DEFRAG', 'DELTA', 'DELTA32K', 'DESC', 'DISABLE',
-                                'DISTINCT', 'DO', 'ELSE', 'EMPTYASNULL', 'ENABLE',
-                                'ENCODE', 'ENCRYPT', 'ENCRYPTION', 'END', 'EXCEPT',
-                                'EXPLICIT', 'FALSE', 'FOR', 'FOREIGN', 'FREEZE', 'FROM',
-                                'FULL', 'GLOBALDICT256', 'GLOBALDICT64K', 'GRANT', 'GROUP',
-                                'GZIP', 'HAVING', 'IDENTITY', 'IGNORE', 'ILIKE', 'IN',
-                                'INITIALLY', 'INNER', 'INTERSECT', 'INTO', 'IS', 'ISNULL',
-                                'JOIN', 'LEADING', 'LEFT', 'LIKE', 'LIMIT', 'LOCALTIME',
-                                'LOCALTIMESTAMP', 'LUN', 'LUNS', 'LZO', 'LZOP', 'MINUS',
-                                'MOSTLY13', 'MOSTLY32', 'MOSTLY8', 'NATURAL', 'NEW', 'NOT',
-                                'NOTNULL', 'NULL', 'NULLS', 'OFF', 'OFFLINE', 'OFFSET',
-                                'OID', 'OLD', 'ON', 'ONLY', 'OPEN', 'OR', 'ORDER', 'OUTER',
-                                'OVERLAPS', 'PARALLEL', 'PARTITION', 'PERCENT', 'PERMISSIONS',
-                                'PLACING', 'PRIMARY', 'RAW', 'READRATIO', 'RECOVER',
-                                'REFERENCES', 'RESPECT', 'REJECTLOG', 'RESORT', 'RESTORE',
-                                'RIGHT', 'SELECT', 'SESSION_USER', 'SIMILAR', 'SNAPSHOT ',
-                                'SOME', 'SYSDATE', 'SYSTEM', 'TABLE', 'TAG', 'TDES',
-                                'TEXT255', 'TEXT32K', 'THEN', 'TIMESTAMP', 'TO', 'TOP',
-                                'TRAILING', 'TRUE', 'TRUNCATECOLUMNS', 'UNION', 'UNIQUE',
-                                'USER', 'USING', 'VERBOSE', 'WALLET', 'WHEN', 'WHERE',
-                                'WITH', 'WITHOUT']
+        # key to row hash index of tables upserted with change detection
+        self._row_hash_index = {}
+        # table name to list of (column, type), None for tables known not to exist
+        self._table_columns = {}
+        # names of the tables known to have a distribution or sort key
+        self._keyed_tables = set()
+        # staging tables known to exist in the session of the connection, None when they can't be tracked
+        self._staging_tables = self._get_session_staging_tables(self.connector)
+        self._reserved_words = RESERVED_WORDS
 
     def __enter__(self, **kwargs):
         return self
@@ -76,29 +99,86 @@ class RedshiftClient(object):
     def __exit__(self, *args):
         self.cursor.close()
 
+    @staticmethod
+    def _get_session_staging_tables(connector) -> set:
+        """Returns the set of staging tables known to exist in the session of a connection"""
+
+        with _session_staging_tables_lock:
+            try:
+                return _session_staging_tables.setdefault(connector, set())
+            except TypeError:
+                # connection without weak reference support
+                return None
+
     def add_reserved_words(self, words: list) -> None:
         """Adds a reserved word to the connector attribute for later use"""
 
         if isinstance(words, list):
-                self._reserved_words = self._reserved_words + \
-                [str(w) for w in set(words) if w not in self._reserved_words]
+            self._reserved_words = self._reserved_words | frozenset(str(w).strip().lower() for w in words)
         else:
             raise TypeError(f'Invalid type passed to add_reserved_words(): {type(words)}, expected str of list ')
 
-    def _validate_column_names(self, df: pandas.DataFrame) -> pandas.DataFrame:
+    def _validate_column_names(self, df: 'pandas.DataFrame') -> 'pandas.DataFrame':
         """Validate the column names to ensure no reserved words are used."""
 
-        reserved_words = [r.strip().lower() for r in self._reserved_words]
-
         df.columns = [x.lower().replace(' ', '_') for x in df.columns]
 
         for col in df.columns:
-            try:
-                assert col not in reserved_words
-            except AssertionError:
+            if col in self._reserved_words:
                 raise ValueError(f'DataFrame column name {col} is a reserved word')
         return df
 
+    def _get_table_columns(self, table_name: str) -> list:
+        """Retrieves the (column, type) list of a table, loaded once from the catalog, None if the table doesn't exist"""
+
+        key = table_name.lower()
+        if key not in self._table_columns:
+            if '.' in key:
+                schema, table = key.split('.', 1)
+                schema_condition = 'n.nspname = %s'
+                parameters = (schema, table)
+            else:
+                schema_condition = 'n.nspname = current_schema()'
+                parameters = (key,)
+            self.cursor.execute(f"""
+                SELECT a.attname, format_type(a.atttypid, a.atttypmod), a.attisdistkey, a.attsortkeyord
+                FROM pg_attribute a
+                JOIN pg_class c ON c.oid = a.attrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE {schema_condition} AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped
+                ORDER BY a.attnum;
+            """, parameters)
+            rows = self.cursor.fetchall()
+            self._table_columns[key] = [(r[0], r[1]) for r in rows] if len(rows) > 0 else None
+            if any(r[2] or r[3] for r in rows):
+                self._keyed_tables.add(key)
+        return self._table_columns[key]
+
+    def _table_metadata_keys(self, table_name: str) -> list:
+        """Retrieves the metadata keys possibly designating a table, qualified or not by its schema"""
+
+        key = table_name.lower()
+        if '.' in key:
+            return [key, key.split('.', 1)[1]]
+        return [key] + [k for k in self._table_columns if '.' in k and k.split('.', 1)[1] == key]
+
+    def invalidate_results(self, table_name: str = None) -> None:
+        """Invalidates the cached get_df results depending on a table, or all of them"""
+        if self.result_cache is not None:
+            self.result_cache.invalidate(table=table_name)
+
+    def invalidate_table_metadata(self, table_name: str = None) -> None:
+        """Forgets the cached metadata of a table, or of all tables, to reload it from the catalog when needed"""
+
+        if table_name is None:
+            self._table_columns.clear()
+            self._keyed_tables.clear()
+        else:
+            # the table may be known under its qualified and its unqualified names
+            for key in self._table_metadata_keys(table_name):
+                self._table_columns.pop(key, None)
+                self._keyed_tables.discard(key)
+
     @staticmethod
     def _to_redshift_types(dtype_: str) -> str:
         """Retrieves corresponding valid Redshift type given a type name"""
@@ -113,7 +193,7 @@ class RedshiftClient(object):
         else:
             return 'VARCHAR(256)'
 
-    def _get_column_data_types(self, df: pandas.DataFrame, index: bool = False) -> list:
+    def _get_column_data_types(self, df: 'pandas.DataFrame', index: bool = False) -> list:
         """Retrieves redshift compatible data types from a DataFrame"""
         column_data_types = [self._to_redshift_types(dtype_.name) for dtype_ in df.dtypes.values]
         if index:
@@ -133,8 +213,9 @@ class RedshiftClient(object):
                         region: str = '',
                         parameters: str = '',
                         aws_role: str = None,
-                        aws_token: str = ''):
-        """Executes a COPY command from Redshift to load data from S3"""
+                        aws_token: str = '',
+                        manifest: bool = False):
+        """Executes a COPY command from Redshift to load data from S3, s3_key being a manifest file if manifest"""
 
         # get authentication information
         s3_file_path = f's3://{s3_bucket_name}/{s3_key}'
@@ -167,6 +248,9 @@ class RedshiftClient(object):
         {parameters}
         """
 
+        if manifest:
+            s3_to_sql = s3_to_sql + "MANIFEST\n"
+
         if region:
             s3_to_sql = s3_to_sql + f"region '{region}'"
 
@@ -189,7 +273,7 @@ class RedshiftClient(object):
             raise
 
     def _create_redshift_table(self,
-                               df: pandas.DataFrame,
+                               df: 'pandas.DataFrame',
                                redshift_table_name: str,
                                column_data_types: list = None,
                                column_constraints: list = None,
@@ -199,8 +283,14 @@ class RedshiftClient(object):
                                sort_interleaved: bool = False,
                                sortkey: str = '',
                                include_date_insert: bool = True,
-                               debug=False):
-        """Create a Redshift table based on a schema build from a DataFrame object"""
+                               debug=False,
+                               commit: bool = True):
+        """Create a Redshift table based on a schema build from a DataFrame object, unless the table exists,
+        the creation being left in the current transaction unless commit"""
+
+        if self._get_table_columns(redshift_table_name) is not None:
+            logger.debug(f'Table {redshift_table_name} already exists')
+            return
 
         columns = list(df.columns)
 
@@ -244,10 +334,16 @@ class RedshiftClient(object):
             logger.debug(create_table_query)
 
         self.cursor.execute(create_table_query)
-        self.connector.commit()
+        if commit:
+            self.connector.commit()
+        self.invalidate_table_metadata(redshift_table_name)
+        self._table_columns[redshift_table_name.lower()] = list(zip(columns, column_data_types)) + \
+            ([('date_insert', 'timestamp without time zone')] if include_date_insert else [])
+        if distkey or sortkey:
+            self._keyed_tables.add(redshift_table_name.lower())
 
     def _pandas_to_redshift(self,
-                            df: pandas.DataFrame,
+                            df: 'pandas.DataFrame',
                             redshift_table_name: str,
                             s3_bucket_name: str,
                             s3_key_prefix: str,
@@ -267,47 +363,84 @@ class RedshiftClient(object):
                             aws_role: str = '',
                             aws_token: str = '',
                             drop_table: bool = False,
+                            keep_staging: bool = False,
                             debug: bool = False
                             ):
-        """Private method to create and load data from a DataFrame to a Redshift table"""
+        """Private method to create and load data from a DataFrame to a Redshift table,
+        the staged file being uploaded while the table is created, and removed once copied unless keep_staging"""
 
         df = self._validate_column_names(df)
 
         d = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
         s3_key = f"{s3_key_prefix}/{redshift_table_name.replace('.', '/')}/{d}.csv.gz"
-        put_df(self.s3_client, df, s3_bucket_name, s3_key, format='csv', compression='gzip')
-
-        if drop_table:
-            logger.info(">>Droping table")
-            self.cursor.execute(f'DROP TABLE IF EXISTS {redshift_table_name} CASCADE;')
-
-        self._create_redshift_table(df,
-                                    redshift_table_name,
-                                    column_data_types=column_data_types,
-                                    column_constraints=column_constraints,
-                                    index=index,
-                                    diststyle=diststyle,
-                                    distkey=distkey,
-                                    sort_interleaved=sort_interleaved,
-                                    sortkey=sortkey,
-                                    debug=debug
-                                    )
-
-        self._s3_to_redshift(redshift_table_name,
-                             list(df.columns),
-                             s3_bucket_name,
-                             s3_key,
-                             delimiter,
-                             quotechar,
-                             dateformat,
-                             timeformat,
-                             region,
-                             parameters,
-                             aws_role,
-                             aws_token)
+
+        def create_table(commit):
+            self._create_redshift_table(df,
+                                        redshift_table_name,
+                                        column_data_types=column_data_types,
+                                        column_constraints=column_constraints,
+                                        index=index,
+                                        diststyle=diststyle,
+                                        distkey=distkey,
+                                        sort_interleaved=sort_interleaved,
+                                        sortkey=sortkey,
+                                        debug=debug,
+                                        commit=commit
+                                        )
+
+        try:
+            # the upload doesn't depend on the DDL statements, both are run at the same time
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                upload = executor.submit(put_df, self.s3_client, df, s3_bucket_name, s3_key,
+                                         format='csv', compression='gzip')
+                if drop_table:
+                    # the table is dropped and created in a transaction committed with the COPY,
+                    # a failed upload or copy keeps its rows
+                    logger.info(">>Droping table")
+                    self.cursor.execute(f'BEGIN TRANSACTION; DROP TABLE IF EXISTS {redshift_table_name} CASCADE;')
+                    self.invalidate_table_metadata(redshift_table_name)
+                    self._table_columns[redshift_table_name.lower()] = None
+                create_table(commit=not drop_table)
+                staged_keys = upload.result()
+
+            self._s3_to_redshift(redshift_table_name,
+                                 list(df.columns),
+                                 s3_bucket_name,
+                                 s3_key,
+                                 delimiter,
+                                 quotechar,
+                                 dateformat,
+                                 timeformat,
+                                 region,
+                                 parameters,
+                                 aws_role,
+                                 aws_token)
+        except Exception:
+            if drop_table:
+                # the dropped table is restored, its metadata is retrieved again
+                self.connector.rollback()
+                self.invalidate_table_metadata(redshift_table_name)
+            raise
+
+        self.invalidate_results(redshift_table_name)
+        if not keep_staging:
+            self._delete_staged_objects(s3_bucket_name, staged_keys)
+
+    def _delete_staged_objects(self, s3_bucket_name: str, s3_keys: list) -> None:
+        """Removes staged files from S3, failures being logged as data is already loaded"""
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.s3_client.delete_objects(Bucket=s3_bucket_name,
+                                                     Delete={'Objects': [{'Key': k} for k in s3_keys], 'Quiet': True})
+        except ClientError as e:
+            logger.warning(f'Staged files not removed: {e}')
+            return
+        for error in response.get('Errors', []):
+            logger.warning(f"Staged file {error.get('Key')} not removed: {error.get('Message')}")
 
     def upload_to_redshift(self,
-                           df: pandas.DataFrame,
+                           df: 'pandas.DataFrame',
                            redshift_table_name: str,
                            s3_bucket_name: str,
                            s3_key_prefix: str,
@@ -333,17 +466,36 @@ class RedshiftClient(object):
 
         logger.info("Data loaded to Redshift")
 
+    def stream_writer(self,
+                      redshift_table_name: str,
+                      s3_bucket_name: str,
+                      s3_key_prefix: str,
+                      aws_role: str,
+                      **kwargs):
+        """Public method to get a RedshiftStreamWriter loading DataFrames into a Redshift table by batches"""
+        return RedshiftStreamWriter(self, redshift_table_name, s3_bucket_name, s3_key_prefix, aws_role, **kwargs)
+
     def _create_temp_redshift_table_from_target(self, target_redshift_table_name):
         """Create a temporary table based on a target table exisitng in redshift"""
 
-        self.cursor.execute(f'DROP TABLE IF EXISTS stage_{target_redshift_table_name}')
-        create_table_query = f'CREATE TEMP TABLE stage_{target_redshift_table_name} (LIKE {target_redshift_table_name})'
+        stage_table_name = f'stage_{target_redshift_table_name}'
+        if self._staging_tables is None or stage_table_name in self._staging_tables:
+            self.cursor.execute(f'DROP TABLE IF EXISTS {stage_table_name}')
 
         logger.info('CREATING A TABLE IN REDSHIFT')
 
-        self.cursor.execute(create_table_query)
-        self.cursor.execute(f'ALTER TABLE stage_{target_redshift_table_name} DROP COLUMN date_insert;')
+        columns = self._get_table_columns(target_redshift_table_name)
+        if columns is not None and target_redshift_table_name.lower() not in self._keyed_tables:
+            # known columns avoid the LIKE copy and the date_insert column drop,
+            # LIKE is kept for tables with distribution or sort keys, so that the staging table is joined locally
+            columns_and_data_type = ', '.join([f'{c} {t}' for c, t in columns if c != 'date_insert'])
+            self.cursor.execute(f'CREATE TEMP TABLE {stage_table_name} ({columns_and_data_type})')
+        else:
+            self.cursor.execute(f'CREATE TEMP TABLE {stage_table_name} (LIKE {target_redshift_table_name})')
+            self.cursor.execute(f'ALTER TABLE {stage_table_name} DROP COLUMN date_insert;')
         self.connector.commit()
+        if self._staging_tables is not None:
+            self._staging_tables.add(stage_table_name)
 
     def _delete_target_redshift_table_line(self, origin_table_name: str, target_table_name: str, key: list):
         """Delete rows in a Redshift table based on another table content"""
@@ -382,20 +534,91 @@ class RedshiftClient(object):
 
         self.cursor.execute(query)
         self.connector.commit()
+        if drop_origin_table and self._staging_tables is not None:
+            self._staging_tables.discard(origin_table_name)
+
+    @staticmethod
+    def _row_hashes(df: 'pandas.DataFrame', comparison_key: list) -> 'pandas.Series':
+        """Computes a hash of the non key columns of each row, indexed by the row key"""
+        import numpy
+        import pandas
+
+        values = df[sorted(c for c in df.columns if c not in comparison_key)]
+        if len(values.columns) == 0:
+            # rows made of their key only never change once known
+            hashes = numpy.zeros(len(df), dtype='int64')
+        else:
+            # signed values fit in a Redshift BIGINT column
+            hashes = pandas.util.hash_pandas_object(values, index=False).values.view('int64')
+        if len(comparison_key) == 1:
+            index = pandas.Index(df[comparison_key[0]])
+        else:
+            index = pandas.MultiIndex.from_frame(df[comparison_key])
+        return pandas.Series(hashes, index=index, name='row_hash')
+
+    def _load_row_hashes(self,
+                         target_table_name: str,
+                         comparison_key: list,
+                         update_df: 'pandas.DataFrame',
+                         change_detection: str) -> 'pandas.Series':
+        """Retrieves the key to row hash index of a table, from the client or its Redshift side table"""
+
+        if target_table_name in self._row_hash_index:
+            return self._row_hash_index[target_table_name]
+
+        hashes = self._row_hashes(update_df.iloc[:0], comparison_key)
+        if change_detection == 'redshift':
+            hash_table_name = f'{target_table_name}_row_hashes'
+            self._create_redshift_table(update_df[comparison_key].assign(row_hash=0),
+                                        hash_table_name,
+                                        column_data_types=self._get_column_data_types(update_df[comparison_key])
+                                        + ['BIGINT'])
+            # read from Redshift, a cached index could miss changes made by other clients
+            hash_df = self.get_df(f'SELECT {", ".join(comparison_key)}, row_hash FROM {hash_table_name}',
+                                  use_cache=False)
+            if len(hash_df) > 0:
+                hashes = hash_df.set_index(comparison_key)['row_hash'].astype('int64')
+                # side tables written before keys were deduplicated may hold a key more than once
+                hashes = hashes[~hashes.index.duplicated(keep='last')]
+        self._row_hash_index[target_table_name] = hashes
+        return hashes
 
     def upsert_rows(
                     self,
-                    update_df: pandas.DataFrame,
+                    update_df: 'pandas.DataFrame',
                     target_table_name: str,
                     s3_bucket_name: str,
                     s3_key_prefix: str,
                     comparison_key: list,
                     aws_role: str,
+                    change_detection: str = None,
                     **kwargs) -> None:
-        """Performs an upsert lines into a target Redshift table based on a DataFrame content"""
+        """Performs an upsert lines into a target Redshift table based on a DataFrame content,
+        change_detection being 'local' or 'redshift' to only upsert rows unknown or changed since the previous calls,
+        row hashes being kept by the client, or in a {target_table_name}_row_hashes Redshift table"""
+        import pandas
+
+        assert change_detection in [None, 'local', 'redshift'], \
+            'provider change_detection value not accepted'
 
         d = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
         update_df = self._validate_column_names(update_df)
+
+        if change_detection is not None:
+            hashes = self._row_hashes(update_df, comparison_key)
+            known_hashes = self._load_row_hashes(target_table_name, comparison_key, update_df, change_detection)
+            changed = ~hashes.index.isin(known_hashes.index)
+            known = ~changed
+            if known.any():
+                changed[known] = known_hashes.loc[hashes.index[known]].values != hashes.values[known]
+            logger.info(f'{changed.sum()} new or changed rows out of {len(update_df)}')
+            update_df = update_df[changed]
+            hashes = hashes[changed]
+            # a key upserted more than once keeps the hash of its last row
+            hashes = hashes[~hashes.index.duplicated(keep='last')]
+            if len(update_df) == 0:
+                return
+
         s3_key = f"{s3_key_prefix}/{self.schema}/{target_table_name}/{d}.csv.gz"
         put_df(self.s3_client, update_df, s3_bucket_name, s3_key, format='csv', compression='gzip')
         self._create_temp_redshift_table_from_target(target_table_name)
@@ -414,11 +637,86 @@ class RedshiftClient(object):
         self._insert_target_redshift_table_line(f'stage_{target_table_name}',
                                                 target_table_name
                                                 )
+        self.invalidate_results(target_table_name)
+
+        if change_detection is not None:
+            # hashes are only recorded once rows are merged
+            if change_detection == 'redshift':
+                self.upsert_rows(hashes.reset_index(),
+                                 f'{target_table_name}_row_hashes',
+                                 s3_bucket_name,
+                                 s3_key_prefix,
+                                 comparison_key,
+                                 aws_role)
+            known_hashes = self._row_hash_index[target_table_name]
+            self._row_hash_index[target_table_name] = pandas.concat(
+                [known_hashes[~known_hashes.index.isin(hashes.index)], hashes])
+
+    @staticmethod
+    def _rows_to_df(rows: list, columns: list, output: str = 'pandas'):
+        """Builds a DataFrame, or a pyarrow.Table with output 'arrow', from fetched rows"""
+        import pandas
+        import pyarrow
+
+        if output == 'arrow':
+            return pyarrow.Table.from_arrays([pyarrow.array(c) for c in zip(*rows)], names=columns)
+        df = pandas.DataFrame(rows)
+        df.columns = columns
+        return df
+
+    @staticmethod
+    def _rename_columns(df, columns_: dict):
+        """Renames the columns of a DataFrame, or a pyarrow.Table, given a mapping"""
+        import pyarrow
+
+        if isinstance(df, pyarrow.Table):
+            return df.rename_columns([columns_.get(c) or c for c in df.column_names])
+        return df.rename(index=str, columns={k: v for k, v in columns_.items() if v})
+
     def get_df(
             self,
             query: str,
             columns_: list() = None,
-            fetch_size: int = 1e6) -> pandas.DataFrame:
+            fetch_size: int = 1e6,
+            output: str = 'pandas',
+            use_cache: bool = True,
+            depends_on: list = None,
+            memory: str = None):
+        """Executes a query on Redshift and retrieves its result as a DataFrame, or a pyarrow.Table with output 'arrow',
+        results being cached by database when the client has a result_cache, and invalidated by writes to the depends_on
+        tables, memory being 'compact' to downcast numeric columns and turn strings into categoricals or arrow-backed strings"""
+
+        assert output in ['pandas', 'arrow'], \
+            'provider output value not accepted'
+        assert memory in [None, 'compact'], \
+            'provider memory value not accepted'
+
+        if self.result_cache is None or not use_cache:
+            return self._fetch_df(query, columns_, fetch_size, output, memory)
+
+        key = self.result_cache.key(query, database=self._database_identity(), schema=self.schema,
+                                    columns_=columns_, output=output, memory=memory)
+        result = self.result_cache.get(key)
+        if result is not None:
+            logger.debug(f'Result of {query} retrieved from cache')
+            return result
+        result = self._fetch_df(query, columns_, fetch_size, output, memory)
+        self.result_cache.set(key, result, tables=depends_on)
+        return result
+
+    def _database_identity(self) -> dict:
+        """Identifies the database of the connector by its host, port and name, empty if the connector doesn't tell"""
+
+        get_dsn_parameters = getattr(self.connector, 'get_dsn_parameters', None)
+        parameters = get_dsn_parameters() if callable(get_dsn_parameters) else None
+        if not isinstance(parameters, dict):
+            return {}
+        return {k: parameters.get(k) for k in ['host', 'port', 'dbname']}
+
+    def _fetch_df(self, query: str, columns_: dict, fetch_size: int, output: str, memory: str = None):
+        """Private method executing a query on Redshift and fetching its result"""
+        import pandas
+        import pyarrow
 
         logger.debug(f'Execution {query} on Redshift')
         try:
@@ -436,13 +734,278 @@ class RedshiftClient(object):
             if len(r) == 0:
                 break
             else:
-                df_l.append(pandas.DataFrame(r))
+                df_l.append(self._rows_to_df(r, columns, output))
+        if output == 'arrow':
+            if len(df_l) == 0:
+                logger.warning('Retrieved table is void')
+                return pyarrow.Table.from_arrays([pyarrow.array([]) for _ in columns], names=columns)
+            table = pyarrow.concat_tables(_unify_arrow_tables(df_l))
+            if columns_:
+                table = self._rename_columns(table, columns_)
+            return table
         try:
             df = pandas.concat(df_l, axis=0)
-            df.columns = columns
-            if columns_:
-                df = df.rename(index=str, columns={k: v for k, v in columns_.items() if v})
-            return df
         except ValueError as e:
             logger.warning('Retrieved dataframe is void')
             return pandas.DataFrame()
+        if columns_:
+            df = self._rename_columns(df, columns_)
+        if memory == 'compact':
+            df = _compact_df(df)
+        return df
+
+    def iter_df(
+            self,
+            query: str,
+            chunksize: int = 100000,
+            columns_: dict = None,
+            output: str = 'pandas'):
+        """Executes a query on Redshift and yields its result chunk by chunk, as DataFrames or pyarrow.Tables with
+        output 'arrow', rows are kept server-side by a named cursor until fetched"""
+
+        assert output in ['pandas', 'arrow'], \
+            'provider output value not accepted'
+        assert chunksize > 0, 'Chunk size not accepted, it must be > 0'
+
+        logger.debug(f'Execution {query} on Redshift')
+        cursor = self.connector.cursor(name=f'pandas_aws_{uuid.uuid4().hex}')
+        cursor.itersize = chunksize
+        try:
+            cursor.execute(query)
+            while True:
+                r = cursor.fetchmany(chunksize)
+                if len(r) == 0:
+                    break
+                # named cursors only get a description once rows are fetched
+                df = self._rows_to_df(r, [c[0] for c in cursor.description], output)
+                if columns_:
+                    df = self._rename_columns(df, columns_)
+                yield df
+        except Exception as e:
+            logger.error(e)
+            traceback.print_exc(file=sys.stdout)
+            cursor.close()
+            self.connector.rollback()
+            raise
+        finally:
+            # also reached when the generator is closed before its end
+            if not cursor.closed:
+                cursor.close()
+                self.connector.commit()
+
+
+class RedshiftStreamWriter(object):
+    """
+    Buffers DataFrames in memory and loads them into a Redshift table by batches,
+    a batch being sent once a row, byte or time threshold is reached.
+    Batches are serialized, uploaded and copied in a background thread using
+    a single COPY command per batch, from a manifest file listing its parts.
+    The RedshiftClient must not be used by other threads while batches are loaded.
+    The error of a failed batch is raised by the next write, flush or close, with the rows of the batch
+    in its df attribute, so that they can be written again.
+    """
+
+    _create_arguments = ['column_data_types', 'column_constraints', 'diststyle', 'distkey',
+                         'sort_interleaved', 'sortkey']
+    _copy_arguments = ['delimiter', 'quotechar', 'dateformat', 'timeformat', 'region', 'parameters', 'aws_token']
+
+    def __init__(self,
+                 client: RedshiftClient,
+                 redshift_table_name: str,
+                 s3_bucket_name: str,
+                 s3_key_prefix: str,
+                 aws_role: str,
+                 max_rows: int = 1000000,
+                 max_bytes: int = 256 * 1024 ** 2,
+                 max_seconds: float = 60,
+                 max_pending_batches: int = 2,
+                 parts: int = 1,
+                 keep_staging: bool = False,
+                 **kwargs):
+        """
+        :param client: RedshiftClient used to run the DDL and COPY commands
+        :param redshift_table_name: target table name, in the client schema
+        :param s3_bucket_name: bucket name of the staged files
+        :param s3_key_prefix: aws key prefix of the staged files
+        :param aws_role: role used by Redshift to read the staged files
+        :param max_rows: number of buffered rows triggering a batch
+        :param max_bytes: memory usage of buffered DataFrames triggering a batch
+        :param max_seconds: maximum time a buffered DataFrame waits for its batch
+        :param max_pending_batches: number of batches loading in background before write() blocks
+        :param parts: number of files per batch
+        :param keep_staging: keep the staged files and manifest of the loaded batches, removed by default
+        :param '**kwargs': used for passing arguments to table creation and COPY commands
+        """
+        assert max_rows > 0 and max_bytes > 0 and max_seconds > 0, 'Thresholds not accepted, they must be > 0'
+        assert max_pending_batches > 0, 'Number of pending batches not accepted, it must be > 0'
+        unexpected = set(kwargs) - set(self._create_arguments + self._copy_arguments)
+        if unexpected:
+            raise TypeError(f'RedshiftStreamWriter got unexpected keyword arguments: {sorted(unexpected)}')
+
+        self.client = client
+        self.redshift_table_name = f'{client.schema}.{redshift_table_name}'
+        self.s3_bucket_name = s3_bucket_name
+        self.s3_key_prefix = s3_key_prefix
+        self.aws_role = aws_role
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_pending_batches = max_pending_batches
+        self.parts = parts
+        self.keep_staging = keep_staging
+        self.kwargs = kwargs
+
+        self.closed = False
+        self._lock = threading.RLock()
+        self._frames = []
+        self._rows = 0
+        self._bytes = 0
+        self._timer = None
+        self._batch_id = 0
+        self._table_created = False
+        self._pending = []
+        # errors of failed batches, raised by the next write, flush or close
+        self._errors = []
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, df: 'pandas.DataFrame') -> None:
+        """Buffers a DataFrame, sending a batch if a threshold is reached"""
+        import pandas
+
+        if not isinstance(df, pandas.DataFrame):
+            raise TypeError('Provided content must type pandas.DataFrame')
+        with self._lock:
+            if self.closed:
+                raise ValueError('write() called on a closed RedshiftStreamWriter')
+            self._check_pending()
+            if len(df) == 0:
+                return
+            self._frames.append(df)
+            self._rows += len(df)
+            self._bytes += int(df.memory_usage(deep=True).sum())
+            if self._rows >= self.max_rows or self._bytes >= self.max_bytes:
+                self._send_batch()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_seconds, self._send_timed_batch)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """Sends buffered DataFrames, then waits for all batches to be loaded"""
+
+        with self._lock:
+            self._send_batch()
+            pending = list(self._pending)
+        wait(pending)
+        with self._lock:
+            self._check_pending()
+
+    def close(self) -> None:
+        """Flushes buffered DataFrames and stops the background thread"""
+
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.closed = True
+            self._executor.shutdown(wait=True)
+
+    def _check_pending(self) -> None:
+        """Forgets loaded batches, raising the error of any failed batch with the rows of all failed batches"""
+        import pandas
+
+        for future in [f for f in self._pending if f.done()]:
+            self._record_error(future)
+        self._pending = [f for f in self._pending if not f.done()]
+        if self._errors:
+            errors, self._errors = self._errors, []
+            dfs = [e.df for e in errors if getattr(e, 'df', None) is not None]
+            if dfs:
+                errors[0].df = pandas.concat(dfs, axis=0, ignore_index=True)
+            raise errors[0]
+
+    def _record_error(self, future) -> None:
+        """Keeps the error of a done batch, to raise it from the caller thread"""
+
+        if future.exception() is not None:
+            logger.error(f'Batch loading failed: {future.exception()}')
+            self._errors.append(future.exception())
+
+    def _send_timed_batch(self) -> None:
+        """Sends a batch from the timer thread, keeping its error for the caller thread"""
+
+        try:
+            self._send_batch()
+        except Exception as e:
+            logger.error(f'Batch sending failed: {e}')
+            with self._lock:
+                self._errors.append(e)
+
+    def _send_batch(self) -> None:
+        """Submits buffered DataFrames as a batch to the background thread"""
+
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if len(self._frames) == 0:
+                return
+            while len(self._pending) >= self.max_pending_batches:
+                # back pressure, the oldest batch is waited for before taking the buffered frames,
+                # its error being kept so that the frames are still sent
+                future = self._pending.pop(0)
+                wait([future])
+                self._record_error(future)
+            frames, self._frames = self._frames, []
+            self._rows, self._bytes = 0, 0
+            self._batch_id += 1
+            self._pending.append(self._executor.submit(self._load_batch, frames, self._batch_id))
+
+    def _load_batch(self, frames: list, batch_id: int) -> None:
+        """Loads a batch into the Redshift table, its rows being attached to the raised error on failure"""
+        import pandas
+
+        df = pandas.concat(frames, axis=0, ignore_index=True)
+        frames.clear()
+        try:
+            self._copy_batch(df, batch_id)
+        except Exception as e:
+            e.df = df
+            raise
+
+    def _copy_batch(self, df: 'pandas.DataFrame', batch_id: int) -> None:
+        """Serializes, uploads and copies a batch into the Redshift table"""
+
+        df = self.client._validate_column_names(df)
+
+        d = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        s3_key = f"{self.s3_key_prefix}/{self.redshift_table_name.replace('.', '/')}/{d}-{batch_id:06d}.csv.gz"
+        keys = put_df(self.client.s3_client, df, self.s3_bucket_name, s3_key,
+                      format='csv', compression='gzip', parts=self.parts)
+        manifest_key = f'{s3_key}.manifest'
+        put_manifest(self.client.s3_client, self.s3_bucket_name, manifest_key, keys)
+
+        if not self._table_created:
+            create_kwargs = {k: v for k, v in self.kwargs.items() if k in self._create_arguments}
+            self.client._create_redshift_table(df, self.redshift_table_name, **create_kwargs)
+            self._table_created = True
+
+        copy_kwargs = {k: v for k, v in self.kwargs.items() if k in self._copy_arguments}
+        self.client._s3_to_redshift(self.redshift_table_name,
+                                    list(df.columns),
+                                    self.s3_bucket_name,
+                                    manifest_key,
+                                    aws_role=self.aws_role,
+                                    manifest=True,
+                                    **copy_kwargs)
+        self.client.invalidate_results(self.redshift_table_name)
+        logger.info(f'Batch {batch_id} of {len(df)} rows loaded to {self.redshift_table_name}')
+        if not self.keep_staging:
+            self.client._delete_staged_objects(self.s3_bucket_name, keys + [manifest_key])
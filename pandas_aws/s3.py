@@ -1,21 +1,71 @@
 #  -*- coding: utf-8 -*-
 __author__ = 'fpajot'
 
+from concurrent.futures import ThreadPoolExecutor
 import gzip
-from io import StringIO, BytesIO
+import inspect
+from io import StringIO, BytesIO, SEEK_END
+import json
 import logging
+import math
+import mmap
+import os
 from os import path
 import pickle
+import struct
+import tempfile
 
-import boto3
-import pandas
-import numpy as np
+from .transfer import DEFAULT_SCHEDULER
 
-logging.basicConfig(level=logging.INFO)
+# pandas, numpy and pyarrow are imported by the functions using them,
+# so that importing the module stays fast, i.e for AWS Lambda cold starts
 logger = logging.getLogger(__name__)
 
+# objects larger than the chunk size are downloaded as concurrent byte ranges
+DOWNLOAD_CHUNK_SIZE = 64 * 1024 ** 2
+DOWNLOAD_CONCURRENCY = 10
 
-def get_keys(s3: boto3.resources.base.ServiceResource,
+# compression codecs supported for csv and pickle files
+COMPRESSIONS = [None, 'gzip', 'zstd', 'lz4', 'snappy']
+# snappy raw format has no magic bytes, its content is identified by ContentEncoding only
+_COMPRESSION_MAGIC_BYTES = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd', b'\x04\x22\x4d\x18': 'lz4'}
+
+# pickle files with out-of-band buffers end with the buffers layout,
+# its size as an unsigned 64 bits integer and this marker
+_PICKLE_BUFFERS_MARKER = b'PDAWSOOB'
+_PICKLE_BUFFERS_ALIGNMENT = 64
+
+# number of rows serialized to estimate the size of a DataFrame, for target_part_bytes
+PART_SIZE_SAMPLE_ROWS = 10000
+
+# maximum number of rows of an Excel sheet, header included
+EXCEL_MAX_ROWS = 1048576
+# xlsx files are written to memory up to this size, then to a temporary file
+XLSX_SPOOL_SIZE = 64 * 1024 ** 2
+# number of rows converted at once to python objects when writing xlsx files
+_XLSX_WRITE_CHUNK_SIZE = 10000
+
+# with memory='compact', string columns with less distinct values than this ratio
+# of their values are read as categoricals
+COMPACT_CATEGORY_RATIO = 0.5
+# number of rows of the sample csv dtypes are inferred from
+COMPACT_SAMPLE_ROWS = 10000
+# size of an empty python str object, used to estimate the memory of object columns
+_PYTHON_STR_SIZE = 49
+
+
+def _key_prefix(bucket: str, key: str) -> str:
+    """
+    Get the prefix S3 requests on a key are accounted to by the transfer scheduler
+    :param bucket: bucket name
+    :param key: aws key, or key prefix
+    :return: bucket name and key folder
+    :rtype: str
+    """
+    return '/'.join([bucket, path.dirname(key)])
+
+
+def get_keys(s3: 'boto3.resources.base.ServiceResource',
              bucket: str, prefix: str = '',
              suffix: str = '',
              **kwargs):
@@ -25,9 +75,17 @@ def get_keys(s3: boto3.resources.base.ServiceResource,
     :param bucket: S3 bucket name.
     :param prefix: Only fetch keys that start with this prefix (optional).
     :param suffix: Only fetch keys that end with this suffix (optional).
+    :param scheduler: TransferScheduler of the S3 requests, pandas_aws.transfer.DEFAULT_SCHEDULER by default
+    :param timeout: maximum duration of the listing in seconds, None for no limit
+    :param deadline: time.monotonic() value after which the listing is abandoned, overriding timeout
+        when the listing is part of a larger operation
     :param '**kwargs': used for passing arguments to list_objects_v2 method
     """
 
+    scheduler = kwargs.pop('scheduler', DEFAULT_SCHEDULER)
+    timeout = kwargs.pop('timeout', None)
+    deadline = kwargs.pop('deadline', None) or scheduler.deadline(timeout)
+
     kwargs.update({'Bucket': bucket})
 
     # do the filtering directly with S3 API.
@@ -38,7 +96,7 @@ def get_keys(s3: boto3.resources.base.ServiceResource,
     while not done:
         # The S3 API response is a large blob of metadata.
         # 'Contents' contains information about the listed objects.
-        resp = s3.list_objects_v2(**kwargs)
+        resp = scheduler.call(_key_prefix(bucket, prefix or ''), s3.list_objects_v2, deadline=deadline, **kwargs)
         if 'Contents' in resp.keys():
             for obj in resp['Contents']:
                 key = obj['Key']
@@ -61,44 +119,341 @@ def _get_splited_df_streams(df, parts, func, buffer_class, **kwargs):
     :param func: function to dump Dataframe
     :param buffer_class: class of stream I/O
     :param sort_keys: list of column names (sort keys)
+    :param hash_partition_by: list of column names, rows are split by a hash of their values instead of by position,
+        rows with the same values always end up in the same part, each part being sorted by sort_keys if any
     :param '**kwargs': used for passing arguments to dumping Dataframe functions
     :return: list of streams, contain parts of Dataframe
     :rtype: list
     """
+    import numpy
+    import pandas
+
     if 'sort_keys' in kwargs.keys():
         sort_keys = kwargs['sort_keys']
         del kwargs['sort_keys']
     else:
         sort_keys = None
 
+    hash_partition_by = kwargs.pop('hash_partition_by', None)
+
     if sort_keys is not None:
         assert len(sort_keys) > 0, 'Sort keys not accepted, it must be not empty list of strings'
+    if hash_partition_by is not None:
+        assert len(hash_partition_by) > 0, 'Hash partition keys not accepted, it must be not empty list of strings'
 
-    func_kwargs = {}
-    for key in kwargs.keys():
-        if key in list(func.__code__.co_varnames):
-            func_kwargs[key] = kwargs[key]
+    # signature follows decorated functions, and keeps every argument
+    # for functions passing their keyword arguments to an engine
+    parameters = inspect.signature(func).parameters
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+        func_kwargs = dict(kwargs)
+    else:
+        func_kwargs = {k: v for k, v in kwargs.items() if k in parameters}
 
     buffers = []
 
-    if sort_keys is None:
-        parts_df = np.array_split(df, parts)
+    if hash_partition_by is not None:
+        hashes = pandas.util.hash_pandas_object(df[hash_partition_by], index=False).values
+        # small integers are sorted with a linear time radix sort,
+        # which keeps the rows order within each part
+        codes = (hashes % parts).astype(numpy.uint16 if parts <= 2 ** 16 else numpy.int64)
+        order = numpy.argsort(codes, kind='stable')
+        bounds = numpy.searchsorted(codes[order], numpy.arange(parts + 1))
+        parts_df = [df.iloc[order[bounds[i]:bounds[i + 1]]] for i in range(parts)]
+        if sort_keys is not None:
+            parts_df = [p.sort_values(sort_keys) for p in parts_df]
+    elif sort_keys is None:
+        parts_df = numpy.array_split(df, parts)
     else:
-        parts_df = np.array_split(df.sort_values(sort_keys), parts)
+        parts_df = numpy.array_split(df.sort_values(sort_keys), parts)
     for p in parts_df:
         b = buffer_class()
-        if func == pandas.DataFrame.to_excel:
-            w = pandas.ExcelWriter(b, engine='xlsxwriter')
-            func(p, w, **func_kwargs)
-            w.save()
-        else:
-            func(p, b, **func_kwargs)
+        func(p, b, **func_kwargs)
         buffers.append(b)
     return buffers
 
 
-def put_df(s3: boto3.resources.base.ServiceResource,
-           df: pandas.DataFrame,
+def _estimate_parts(df, target_part_bytes: int, func, buffer_class,
+                    compression: str = None, compression_level: int = None, **kwargs) -> int:
+    """
+    Estimate the number of parts needed to split a DataFrame into files of about a target size,
+    from the serialized size of a sample of its rows
+    :param df: DataFrame to split
+    :param target_part_bytes: target size in bytes of each part
+    :param func: function to dump Dataframe
+    :param buffer_class: class of stream I/O
+    :param compression: compression applied once serialized, one of COMPRESSIONS
+    :param compression_level: compression level, codec default if None
+    :param '**kwargs': used for passing arguments to dumping Dataframe functions
+    :return: number of parts
+    :rtype: int
+    """
+    kwargs = {k: v for k, v in kwargs.items() if k not in ['sort_keys', 'hash_partition_by']}
+    # evenly spaced rows are more representative than the first ones
+    sample = df.iloc[::max(1, len(df) // PART_SIZE_SAMPLE_ROWS)]
+    buffer = _get_splited_df_streams(sample, 1, func, buffer_class, **kwargs)[0]
+    if hasattr(buffer, 'getvalue'):
+        data = buffer.getvalue()
+        if isinstance(data, str):
+            data = bytes(data, 'utf-8')
+        if compression is not None:
+            data = _compress(data, compression, compression_level)
+        size = len(data)
+    else:
+        size = buffer.seek(0, SEEK_END)
+    estimated_size = size * len(df) / max(len(sample), 1)
+    parts = max(1, math.ceil(estimated_size / target_part_bytes))
+    logger.info(f'Estimated size of {int(estimated_size)} bytes, split into {parts} parts')
+    return parts
+
+
+def _dump_pickle(obj, file, out_of_band: bool = False):
+    """
+    Pickle an object into a file using protocol 5 out-of-band buffers when available,
+    large buffers like numpy arrays are written after the pickle stream as aligned
+    contiguous regions, their layout being written at the end of the file
+    :param obj: object to pickle
+    :param file: binary file-like object
+    :param out_of_band: use out-of-band buffers, the file then being only readable by _load_pickle,
+        otherwise it can be read by pickle.load
+    """
+    if not out_of_band or pickle.HIGHEST_PROTOCOL < 5:
+        pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+
+    buffers = []
+    pickle.dump(obj, file, protocol=5, buffer_callback=buffers.append)
+    if len(buffers) == 0:
+        return
+
+    layout = []
+    for buffer in buffers:
+        raw = buffer.raw()
+        file.write(b'\x00' * (-file.tell() % _PICKLE_BUFFERS_ALIGNMENT))
+        layout.append([file.tell(), raw.nbytes])
+        file.write(raw)
+        buffer.release()
+    footer = json.dumps(layout).encode('utf-8')
+    file.write(footer)
+    file.write(struct.pack('<Q', len(footer)))
+    file.write(_PICKLE_BUFFERS_MARKER)
+
+
+def _load_pickle(data, **kwargs):
+    """
+    Unpickle an object written by _dump_pickle, out-of-band buffers are
+    views on data, thus data should be writable to get writable arrays
+    :param data: bytes-like object
+    :param '**kwargs': used for passing arguments to pickle.loads
+    :return: unpickled object
+    """
+    marker_size = len(_PICKLE_BUFFERS_MARKER)
+    if len(data) < marker_size + 8 or bytes(data[-marker_size:]) != _PICKLE_BUFFERS_MARKER:
+        return pickle.loads(data, **kwargs)
+
+    view = memoryview(data)
+    footer_size = struct.unpack('<Q', view[-marker_size - 8:-marker_size])[0]
+    layout = json.loads(bytes(view[-marker_size - 8 - footer_size:-marker_size - 8]).decode('utf-8'))
+    # bytes past the pickle stream are ignored by pickle.loads
+    return pickle.loads(view, buffers=[view[offset:offset + size] for offset, size in layout], **kwargs)
+
+
+def _dump_xlsx(df, file,
+               sheet_name: str = 'Sheet1',
+               index: bool = False,
+               max_rows_per_sheet: int = EXCEL_MAX_ROWS,
+               constant_memory: bool = False,
+               **kwargs):
+    """
+    Write a DataFrame to an xlsx file, rows beyond the sheet limit are written
+    to additional sheets {sheet_name}_2, {sheet_name}_3, ...
+    :param df: DataFrame to write
+    :param file: binary file-like object to write to
+    :param sheet_name: name of the first sheet
+    :param index: write the DataFrame index as the first columns
+    :param max_rows_per_sheet: maximum number of rows of each sheet, header and start rows included
+    :param constant_memory: write rows one by one using xlsxwriter constant memory mode, instead of
+        pandas.DataFrame.to_excel, see _dump_xlsx_rows for the supported arguments
+    :param '**kwargs': used for passing arguments to pandas.DataFrame.to_excel
+    """
+    import pandas
+
+    startrow = kwargs.get('startrow', 0)
+    assert startrow >= 0, 'Start row not accepted, it must be >= 0'
+    rows_per_sheet = max_rows_per_sheet - startrow - (0 if kwargs.get('header', True) is False else 1)
+    assert rows_per_sheet > 0, 'Number of rows per sheet not accepted, it must be > start row and header'
+
+    sheets = []
+    for sheet_id, sheet_start in enumerate(range(0, max(len(df), 1), rows_per_sheet), start=1):
+        # sheet names are limited to 31 characters
+        suffix = '' if sheet_id == 1 else f'_{sheet_id}'
+        sheets.append((sheet_name[:31 - len(suffix)] + suffix, sheet_start, min(sheet_start + rows_per_sheet, len(df))))
+
+    if constant_memory:
+        _dump_xlsx_rows(df, file, sheets, index=index, **kwargs)
+    else:
+        with pandas.ExcelWriter(file, engine='xlsxwriter') as writer:
+            for name, sheet_start, sheet_end in sheets:
+                df.iloc[sheet_start:sheet_end].to_excel(writer, sheet_name=name, index=index, **kwargs)
+
+
+def _dump_xlsx_rows(df, file, sheets: list,
+                    index: bool = False,
+                    na_rep: str = '',
+                    float_format: str = None,
+                    columns: list = None,
+                    header=True,
+                    startrow: int = 0,
+                    startcol: int = 0,
+                    inf_rep: str = 'inf',
+                    freeze_panes: tuple = None,
+                    **kwargs):
+    """
+    Write a DataFrame to an xlsx file row by row, using xlsxwriter constant memory mode,
+    arguments being those of pandas.DataFrame.to_excel
+    :param df: DataFrame to write
+    :param file: binary file-like object to write to
+    :param sheets: list of sheet name, first row and end row of the DataFrame rows written to each sheet
+    :param index: write the DataFrame index as the first columns
+    :param na_rep: representation of missing values
+    :param float_format: format string floating point numbers are rounded with
+    :param columns: columns to write
+    :param header: write the column names, or list of aliases of the column names
+    :param startrow: row of each sheet the header is written to
+    :param startcol: column of each sheet the first column is written to
+    :param inf_rep: representation of infinity
+    :param freeze_panes: row and column of each sheet the panes are frozen at
+    :param '**kwargs': other pandas.DataFrame.to_excel arguments, not supported
+    """
+    import xlsxwriter
+
+    if len(kwargs) > 0:
+        raise TypeError(f"Arguments not supported for constant memory xlsx files: {', '.join(kwargs.keys())}")
+
+    if columns is not None:
+        df = df[list(columns)]
+    if isinstance(header, (list, tuple)):
+        assert len(header) == len(df.columns), \
+            f'Header not accepted, it must have {len(df.columns)} aliases'
+        df = df.set_axis(header, axis=1)
+    if index:
+        df = df.reset_index()
+    float_columns = [i for i, dtype in enumerate(df.dtypes) if dtype.kind == 'f']
+    workbook = xlsxwriter.Workbook(file, {'constant_memory': True,
+                                          'nan_inf_to_errors': True,
+                                          'remove_timezone': True,
+                                          'strings_to_urls': False,
+                                          'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    for name, sheet_start, sheet_end in sheets:
+        worksheet = workbook.add_worksheet(name)
+        if freeze_panes is not None:
+            worksheet.freeze_panes(*freeze_panes)
+        row = startrow
+        if header is not False:
+            worksheet.write_row(row, startcol, [str(c) for c in df.columns])
+            row += 1
+        # rows must be written in order in constant memory mode, and only a chunk of them
+        # is converted to python objects at a time
+        for chunk_start in range(sheet_start, sheet_end, _XLSX_WRITE_CHUNK_SIZE):
+            chunk = df.iloc[chunk_start:min(chunk_start + _XLSX_WRITE_CHUNK_SIZE, sheet_end)]
+            chunk = chunk.astype(object).where(chunk.notna(), na_rep or None)
+            for i in float_columns:
+                # as written by pandas, infinite floats are replaced and others rounded, but kept as numbers
+                chunk.iloc[:, i] = [v if isinstance(v, str) or v is None
+                                    else (inf_rep if v > 0 else f'-{inf_rep}') if math.isinf(v)
+                                    else float(float_format % v) if float_format else v
+                                    for v in chunk.iloc[:, i]]
+            for values in chunk.itertuples(index=False, name=None):
+                worksheet.write_row(row, startcol, values)
+                row += 1
+    workbook.close()
+
+
+def _compress(data: bytes, compression: str, level: int = None) -> bytes:
+    """
+    Compress data using a codec from COMPRESSIONS
+    :param data: data to compress
+    :param compression: codec name
+    :param level: compression level, codec default if None
+    :return: compressed data
+    :rtype: bytes
+    """
+    import pyarrow
+
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=9 if level is None else level)
+    if level is not None and not pyarrow.Codec.supports_compression_level(compression):
+        logger.warning(f'Compression {compression} has no compression level, {level} ignored')
+        level = None
+    return pyarrow.Codec(compression, compression_level=level).compress(data, asbytes=True)
+
+
+def _decompress(data, compression: str = 'infer', content_encoding: str = None, metadata: dict = None):
+    """
+    Decompress the content of an S3 object
+    :param data: object content
+    :param compression: codec name, None for no compression, or 'infer' to detect it
+        from the object ContentEncoding, then from the data magic bytes
+    :param content_encoding: ContentEncoding of the object
+    :param metadata: user metadata of the object
+    :return: decompressed data, or data itself if not compressed
+    :rtype: bytes-like object
+    """
+    import pyarrow
+
+    if compression == 'infer':
+        # content encodings may be listed, i.e 'gzip,aws-chunked'
+        encodings = [e.strip() for e in (content_encoding or '').split(',')]
+        encodings = [e for e in encodings if e in COMPRESSIONS[1:]]
+        if len(encodings) > 0:
+            compression = encodings[0]
+        else:
+            compression = _COMPRESSION_MAGIC_BYTES.get(bytes(data[:2])) or \
+                          _COMPRESSION_MAGIC_BYTES.get(bytes(data[:4]))
+    assert compression in COMPRESSIONS, 'provider compression value not accepted'
+
+    # data is decompressed into writable buffers, so that arrays built on top of them are writable
+    if compression is None:
+        return data
+    elif compression == 'gzip':
+        return _read_all(gzip.GzipFile(fileobj=BytesIO(data)))
+    elif compression == 'snappy':
+        metadata = metadata or {}
+        assert 'uncompressed-size' in metadata, 'snappy objects must have an uncompressed-size metadata'
+        return bytearray(pyarrow.Codec('snappy').decompress(data, decompressed_size=int(metadata['uncompressed-size'])))
+    return _read_all(pyarrow.CompressedInputStream(pyarrow.BufferReader(data), compression))
+
+
+def _pop_compression(kwargs: dict):
+    """
+    Pop the compression argument of a reading function
+    :param kwargs: keyword arguments of the reading function, codecs not in COMPRESSIONS (i.e bz2, zip or xz)
+        are left in them for pandas reading methods
+    :return: compression to pass to _decompress
+    """
+    compression = kwargs.pop('compression', 'infer')
+    if compression == 'infer' or compression in COMPRESSIONS:
+        return compression
+    kwargs['compression'] = compression
+    return None
+
+
+def _read_all(stream) -> bytearray:
+    """
+    Read a file-like object until its end into a writable buffer
+    :param stream: binary file-like object
+    :return: read data
+    :rtype: bytearray
+    """
+    data = bytearray()
+    while True:
+        chunk = stream.read(DOWNLOAD_CHUNK_SIZE)
+        if len(chunk) == 0:
+            return data
+        data += chunk
+
+
+def put_df(s3: 'boto3.resources.base.ServiceResource',
+           df: 'pandas.DataFrame',
            bucket: str,
            key: str,
            **kwargs
@@ -110,11 +465,30 @@ def put_df(s3: boto3.resources.base.ServiceResource,
     :param bucket: bucket name of the target file
     :param key: aws key of the target file
     :param format: file format to use, i.e csv
-    :param compression: file compression applied
+    :param compression: file compression applied, one of COMPRESSIONS for csv and pickle,
+        any codec supported by the parquet engine, or lz4 and zstd for feather
+    :param compression_level: compression level, codec default if None
     :param parts: number of output files
+    :param target_part_bytes: target size in bytes of each output file, the number of files being
+        estimated from a sample of the DataFrame, exclusive with parts
     :param sort_keys: list of column names (sort keys)
+    :param hash_partition_by: list of column names, rows are split into files by a hash of their values,
+        without sort, each file being sorted by sort_keys if any
+    :param out_of_band: for pickle files, write numpy buffers out-of-band to load them without copy,
+        such files must be read by get_df, False by default
+    :param max_rows_per_sheet: for xlsx files, maximum number of rows of each sheet, header included,
+        following rows are written to additional sheets, EXCEL_MAX_ROWS by default
+    :param constant_memory: for xlsx files, write rows one by one in xlsxwriter constant memory mode,
+        instead of pandas.DataFrame.to_excel, supporting its na_rep, float_format, columns, header, startrow,
+        startcol, inf_rep and freeze_panes arguments only, False by default
+    :param scheduler: TransferScheduler of the S3 requests, pandas_aws.transfer.DEFAULT_SCHEDULER by default
+    :param timeout: maximum duration of the upload in seconds, None for no limit
     :param '**kwargs': used for passing arguments to pandas writing methods
+    :return: keys of the uploaded objects
+    :rtype: list
     """
+    import pandas
+
     # Uploads the given file using a managed uploader,
     # which will split up large files automatically
     # and upload parts in parallel
@@ -133,6 +507,12 @@ def put_df(s3: boto3.resources.base.ServiceResource,
     else:
         compression = None
 
+    if 'compression_level' in kwargs.keys():
+        compression_level = kwargs['compression_level']
+        del kwargs['compression_level']
+    else:
+        compression_level = None
+
     if 'parts' in kwargs.keys():
         parts = kwargs['parts']
         del kwargs['parts']
@@ -141,51 +521,81 @@ def put_df(s3: boto3.resources.base.ServiceResource,
 
     assert parts > 0, 'Number of parts not accepted, it must be > 0'
 
-    assert format in ['csv', 'parquet', 'pickle', 'xlsx'], \
+    target_part_bytes = kwargs.pop('target_part_bytes', None)
+    if target_part_bytes is not None:
+        assert target_part_bytes > 0, 'Target part size not accepted, it must be > 0'
+        assert parts == 1, 'parts and target_part_bytes can not be used together'
+
+    scheduler = kwargs.pop('scheduler', DEFAULT_SCHEDULER)
+    deadline = scheduler.deadline(kwargs.pop('timeout', None))
+
+    assert format in ['csv', 'parquet', 'pickle', 'xlsx', 'feather'], \
         'provider format value not accepted'
 
-    if format == 'csv':
-        assert compression in [None, 'gzip'], \
+    if format in ['csv', 'pickle']:
+        assert compression in COMPRESSIONS, \
             'provider compression value not accepted'
 
-    buffers = []
     content_type = 'text'
     content_encoding = 'default'
 
     if format == 'csv':
         kwargs['index_label'] = False
         kwargs['index'] = False
-        buffers = _get_splited_df_streams(df, parts, pandas.DataFrame.to_csv, StringIO, **kwargs)
-        if compression == 'gzip':
-            logger.info('Using csv compression with gzip')
-            content_type = 'text/csv'  # the original type
-            content_encoding = 'gzip'  # MUST have or browsers will error
-            tmp_buffer = []
-            for buffer in buffers:
-                buffer.seek(0)
-                gz_buffer = BytesIO()
-                # compress string stream using gzip
-                with gzip.GzipFile(mode='w', fileobj=gz_buffer) as gz_file:
-                    gz_file.write(bytes(buffer.getvalue(), 'utf-8'))
-                tmp_buffer.append(gz_buffer)
-            buffers = tmp_buffer
+        func, buffer_class = pandas.DataFrame.to_csv, StringIO
     elif format == 'xlsx':
         kwargs['sheet_name'] = 'Sheet1'
         kwargs['index'] = False
-        buffers = _get_splited_df_streams(df, parts, pandas.DataFrame.to_excel, BytesIO, **kwargs)
+        # large files are spooled to disk, and uploaded from there
+        func, buffer_class = _dump_xlsx, lambda: tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_SIZE)
+        content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     elif format == 'parquet':
-        if 'engine' in kwargs:
-            engine = kwargs['engine']
-        else:
-            engine = 'pyarrow'
-        buffers = _get_splited_df_streams(df, parts, pandas.DataFrame.to_parquet, BytesIO, engine=engine, **kwargs)
+        if 'engine' not in kwargs:
+            kwargs['engine'] = 'pyarrow'
+        # parquet files are compressed internally by the engine
+        if compression is not None:
+            kwargs['compression'] = compression
+        if compression_level is not None:
+            kwargs['compression_level'] = compression_level
+        func, buffer_class = pandas.DataFrame.to_parquet, BytesIO
+    elif format == 'feather':
+        # arrow IPC files are compressed internally, uncompressed by default
+        kwargs['compression'] = 'uncompressed' if compression is None else compression
+        if compression_level is not None:
+            kwargs['compression_level'] = compression_level
+        import pyarrow.feather
+        func, buffer_class = pyarrow.feather.write_feather, BytesIO
+        content_type = 'application/vnd.apache.arrow.file'
     elif format == 'pickle':
-        buffers = _get_splited_df_streams(df, parts, pickle.dump, BytesIO)
-        content_encoding = 'application/octet-stream'
+        func, buffer_class = _dump_pickle, BytesIO
+        content_type = 'application/octet-stream'
     else:
         raise TypeError('File type not supported')
 
-    for bid, buffer in enumerate(buffers, start=1):
+    if target_part_bytes is not None:
+        parts = _estimate_parts(df, target_part_bytes, func, buffer_class,
+                                compression if format in ['csv', 'pickle'] else None, compression_level, **kwargs)
+    buffers = _get_splited_df_streams(df, parts, func, buffer_class, **kwargs)
+
+    keys = []
+    metadata = [{} for _ in buffers]
+    if format in ['csv', 'pickle'] and compression is not None:
+        logger.info(f'Using {format} compression with {compression}')
+        if format == 'csv':
+            content_type = 'text/csv'  # the original type
+        content_encoding = compression  # MUST have or browsers will error
+        tmp_buffer = []
+        for buffer, meta in zip(buffers, metadata):
+            data = buffer.getvalue()
+            if isinstance(data, str):
+                data = bytes(data, 'utf-8')
+            if compression == 'snappy':
+                # raw snappy data can't be decompressed without its size
+                meta['uncompressed-size'] = str(len(data))
+            tmp_buffer.append(BytesIO(_compress(data, compression, compression_level)))
+        buffers = tmp_buffer
+
+    for bid in range(1, len(buffers) + 1):
         if parts == 1:
             key_str = key
         else:
@@ -193,54 +603,551 @@ def put_df(s3: boto3.resources.base.ServiceResource,
             basename_parts = basename.split(sep='.')
             obj_name = '.'.join([basename_parts[0], str(bid)] + basename_parts[1:])
             key_str = '/'.join([dirname, basename_parts[0], obj_name])
+        keys.append(key_str)
+
+    def upload(key_str, buffer, meta):
+        if not isinstance(buffer, StringIO):
+            # binary buffers and files are uploaded as is, without getvalue() copy,
+            # rewinded at each attempt
+            buffer.seek(0)
+            body = buffer
+        else:
+            body = buffer.getvalue()
         s3.put_object(
                     Bucket=bucket,
                     Key=key_str,
                     ContentType=content_type,  # the original type
                     ContentEncoding=content_encoding,  # MUST have or browsers will error
-                    Body=buffer.getvalue()
+                    Metadata=meta,
+                    Body=body
                 )
 
+    if len(buffers) == 1:
+        scheduler.call(_key_prefix(bucket, keys[0]), upload, keys[0], buffers[0], metadata[0], deadline=deadline)
+    else:
+        # parts are uploaded concurrently, within the concurrency limit of their prefix
+        with ThreadPoolExecutor(max_workers=min(len(buffers), scheduler.max_concurrency)) as executor:
+            futures = [executor.submit(scheduler.call, _key_prefix(bucket, key_str), upload,
+                                       key_str, buffer, meta, deadline=deadline)
+                       for key_str, buffer, meta in zip(keys, buffers, metadata)]
+            for future in futures:
+                future.result()
+
     if compression is None:
         logger.info(f'File uploaded using format {format}')
     else:
         logger.info(f'File uploaded using format {format}, '
                     f'compression {compression}')
+    return keys
+
+
+def put_manifest(s3: 'boto3.resources.base.ServiceResource',
+                 bucket: str,
+                 key: str,
+                 keys: list,
+                 keys_bucket: str = None):
+    """
+    Put a manifest file listing S3 objects, as used by Redshift COPY commands
+    :param s3: S3 client
+    :param bucket: bucket name of the manifest file
+    :param key: aws key of the manifest file
+    :param keys: aws keys of the listed objects
+    :param keys_bucket: bucket name of the listed objects, the manifest bucket if None
+    """
+    entries = [{'url': f's3://{keys_bucket or bucket}/{k}', 'mandatory': True} for k in keys]
+    s3.put_object(
+                Bucket=bucket,
+                Key=key,
+                ContentType='application/json',
+                Body=json.dumps({'entries': entries}).encode('utf-8')
+            )
+
+
+def _unify_arrow_types(types: list) -> 'pyarrow.DataType':
+    """
+    Get a single arrow type able to hold the values of all the given types
+    :param types: list of pyarrow.DataType found for a same column
+    :return: unified type, numeric types are widened, other conflicts end up as strings
+    :rtype: pyarrow.DataType
+    """
+    import pyarrow
+
+    types = [t for t in types if not pyarrow.types.is_null(t)]
+    if len(types) == 0:
+        return pyarrow.null()
+    if all(t == types[0] for t in types):
+        return types[0]
+    if all(pyarrow.types.is_integer(t) or pyarrow.types.is_boolean(t) for t in types):
+        return pyarrow.int64()
+    if all(pyarrow.types.is_integer(t) or pyarrow.types.is_floating(t) or pyarrow.types.is_boolean(t)
+           for t in types):
+        return pyarrow.float64()
+    if all(pyarrow.types.is_timestamp(t) and t.tz == types[0].tz for t in types):
+        return pyarrow.timestamp('ns', tz=types[0].tz)
+    return pyarrow.string()
+
 
+def _df_to_arrow(df: 'pandas.DataFrame') -> 'pyarrow.Table':
+    """
+    Convert a pandas.DataFrame to a pyarrow.Table, ignoring its index
+    :param df: DataFrame to convert
+    :return: arrow table with one column per DataFrame column
+    :rtype: pyarrow.Table
+    """
+    import pyarrow
+
+    arrays = []
+    for col in df.columns:
+        try:
+            arrays.append(pyarrow.array(df[col], from_pandas=True))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # mixed object columns can't be converted as is
+            logger.warning(f'Column {col} has mixed types, converted to string')
+            arrays.append(pyarrow.array(df[col].where(df[col].isna(), df[col].astype(str)), from_pandas=True))
+    return pyarrow.Table.from_arrays(arrays, names=[str(c) for c in df.columns])
+
+
+def _arrow_data_columns(schema: 'pyarrow.Schema') -> list:
+    """Get the column names of an arrow schema, without the serialized pandas index columns"""
+    metadata = schema.pandas_metadata
+    if metadata is None:
+        return schema.names
+    index_columns = [c for c in metadata.get('index_columns', []) if isinstance(c, str)]
+    return [n for n in schema.names if n not in index_columns]
+
+
+def _unify_arrow_schemas(schemas: list) -> 'pyarrow.Schema':
+    """
+    Build a schema multiple arrow tables can be aligned on
+    :param schemas: list of pyarrow.Schema, may have different columns and types
+    :return: schema of the columns of all the schemas, in order of appearance, with unified types
+    :rtype: pyarrow.Schema
+    """
+    import pyarrow
+
+    columns = [_arrow_data_columns(s) for s in schemas]
+    names = []
+    for c in columns:
+        names += [n for n in c if n not in names]
+    return pyarrow.schema([
+        (n, _unify_arrow_types([s.field(n).type for s, c in zip(schemas, columns) if n in c]))
+        for n in names])
+
+
+def _unify_arrow_tables(tables: list, schema: 'pyarrow.Schema' = None) -> list:
+    """
+    Align multiple arrow tables on a unified schema
+    :param tables: list of pyarrow.Table, may have different columns and types, emptied once aligned
+    :param schema: schema to align the tables on, columns it doesn't have being dropped,
+        by default it is unified from the tables schemas
+    :return: list of pyarrow.Table sharing the same schema, missing columns are filled with nulls
+    :rtype: list
+    """
+    import pyarrow
+
+    if schema is None:
+        schema = _unify_arrow_schemas([t.schema for t in tables])
+
+    aligned = []
+    for t in tables:
+        c = _arrow_data_columns(t.schema)
+        aligned.append(pyarrow.Table.from_arrays(
+            [t.column(f.name).cast(f.type) if f.name in c else pyarrow.nulls(t.num_rows, type=f.type)
+             for f in schema],
+            schema=schema))
+    tables.clear()
+    return aligned
+
+
+def _concat_arrow_to_df(tables: list, memory: str = None) -> 'pandas.DataFrame':
+    """
+    Build a single DataFrame from multiple arrow tables
+    :param tables: list of pyarrow.Table, may have different columns and types, emptied once aligned
+    :param memory: 'compact' to build a memory-optimized DataFrame, see _compact_df
+    :return: concatenated DataFrame, missing columns are filled with nulls
+    :rtype: pandas.DataFrame
+    """
+    import pyarrow
+
+    aligned = _unify_arrow_tables(tables)
+    types_mapper = None
+    string_dtype = _arrow_string_dtype()
+    if memory == 'compact' and string_dtype is not None:
+        # strings stay in arrow memory instead of becoming python objects
+        types_mapper = {pyarrow.string(): string_dtype, pyarrow.large_string(): string_dtype}.get
+    # arrow concatenation doesn't copy data, and self_destruct releases arrow buffers while the DataFrame
+    # is being built, as long as the concatenated table holds the only references to them
+    table = pyarrow.concat_tables(aligned)
+    aligned.clear()
+    df = table.to_pandas(self_destruct=True, split_blocks=True, types_mapper=types_mapper)
+    del table
+    if memory == 'compact':
+        df = _compact_df(df)
+    return df
+
+
+def _arrow_string_dtype():
+    """
+    Get the arrow-backed pandas string dtype
+    :return: pandas.StringDtype('pyarrow'), None if not supported by the installed pandas
+    :rtype: pandas.StringDtype
+    """
+    import pandas
+
+    try:
+        return pandas.StringDtype('pyarrow')
+    except (AttributeError, TypeError, ImportError):
+        return None
+
+
+def _is_string_column(column: 'pandas.Series') -> bool:
+    """Check whether a column only holds strings, or nulls"""
+    import pandas
+
+    if isinstance(column.dtype, pandas.StringDtype):
+        return True
+    return column.dtype == object and pandas.api.types.infer_dtype(column, skipna=True) == 'string'
+
+
+def _string_dtype(column: 'pandas.Series'):
+    """
+    Get the most compact dtype of a string column
+    :param column: column only holding strings, or nulls
+    :return: 'category' for low-cardinality columns, else the arrow-backed string dtype if supported
+    """
+    count = column.count()
+    if count > 0 and column.nunique() <= COMPACT_CATEGORY_RATIO * count:
+        return 'category'
+    return _arrow_string_dtype() or column.dtype
+
+
+def _estimate_default_memory(df: 'pandas.DataFrame') -> int:
+    """
+    Estimate the memory used by a DataFrame with default dtypes, i.e int64, float64 and object columns of str
+    :param df: DataFrame to estimate the memory of
+    :return: estimated memory in bytes
+    :rtype: int
+    """
+    import numpy
+    import pandas
+
+    size = df.index.memory_usage(deep=True)
+    for _, column in df.items():
+        if isinstance(column.dtype, pandas.CategoricalDtype) and _is_string_column(column.cat.categories.to_series()):
+            lengths = column.cat.categories.str.len().values
+            codes = column.cat.codes.values
+            size += len(column) * (8 + _PYTHON_STR_SIZE) + int(lengths[codes[codes >= 0]].sum())
+        elif isinstance(column.dtype, pandas.StringDtype):
+            size += len(column) * (8 + _PYTHON_STR_SIZE) + int(column.str.len().sum())
+        elif isinstance(column.dtype, numpy.dtype) and column.dtype.kind in 'iuf':
+            size += len(column) * 8
+        else:
+            size += column.memory_usage(index=False, deep=True)
+    return size
+
+
+def _compact_df(df: 'pandas.DataFrame') -> 'pandas.DataFrame':
+    """
+    Reduce the memory used by a DataFrame, downcasting integers to the smallest integer type,
+    floats to float32 when no precision is lost, low-cardinality strings to categoricals
+    and other strings to arrow-backed strings, the memory saved is logged
+    :param df: DataFrame to compact, changed in place
+    :return: compacted DataFrame
+    :rtype: pandas.DataFrame
+    """
+    import numpy
+    import pandas
+
+    for col in df.columns:
+        column = df[col]
+        if not isinstance(column, pandas.Series):
+            # duplicated column names
+            continue
+        if isinstance(column.dtype, numpy.dtype) and column.dtype.kind in 'iu':
+            df[col] = pandas.to_numeric(column, downcast='integer')
+        elif isinstance(column.dtype, numpy.dtype) and column.dtype.kind == 'f' and column.dtype.itemsize > 4:
+            downcast = column.values.astype('float32')
+            with numpy.errstate(over='ignore', invalid='ignore'):
+                restored = downcast.astype(column.dtype)
+                # NaN compare as equal, as numpy.array_equal(equal_nan=True) which needs numpy>=1.19
+                if ((restored == column.values) | (numpy.isnan(restored) & numpy.isnan(column.values))).all():
+                    df[col] = downcast
+        elif _is_string_column(column):
+            dtype = _string_dtype(column)
+            if dtype != column.dtype:
+                df[col] = column.astype(dtype)
+
+    default_memory = _estimate_default_memory(df)
+    memory = df.memory_usage(index=True, deep=True).sum()
+    logger.info(f'Compact DataFrame uses {memory} bytes, {default_memory - memory} bytes saved '
+                f'from an estimated {default_memory} bytes with default dtypes')
+    return df
 
-def get_df(s3: boto3.resources.base.ServiceResource,
+
+def _infer_csv_dtypes(data, **kwargs) -> dict:
+    """
+    Infer the dtypes of the string columns of a csv file from a sample of its rows
+    :param data: csv file content
+    :param '**kwargs': used for passing arguments to pandas.read_csv
+    :return: column name to dtype, 'category' or arrow-backed string
+    :rtype: dict
+    """
+    import pandas
+    import pyarrow
+
+    sample_kwargs = {k: v for k, v in kwargs.items() if k not in ['nrows', 'chunksize', 'iterator']}
+    sample = pandas.read_csv(pyarrow.BufferReader(data), nrows=COMPACT_SAMPLE_ROWS, **sample_kwargs)
+    # numeric types are only set once the whole file is parsed, values not in the sample may not fit,
+    # while any value can be read as a string
+    return {c: _string_dtype(sample[c]) for c in sample.columns
+            if isinstance(sample[c], pandas.Series) and _is_string_column(sample[c])}
+
+
+def get_df(s3: 'boto3.resources.base.ServiceResource',
            bucket: str,
            key: str,
            format: str,
+           output: str = 'pandas',
+           download_chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+           download_concurrency: int = DOWNLOAD_CONCURRENCY,
+           local_path: str = None,
            **kwargs):
     """
     Import object from s3 and convert to pandas_utils.DataFrame if possible
     :param s3: S3 client
     :param bucket: bucket name of the target file
     :param key: aws key of the target file
-    :param format: file format to get DataFrame from, i.e csv
-    :param compression: file compression used
-    :param '**kwargs': used for passing arguments to pandas reading methods
+    :param format: file format to get DataFrame from, i.e csv, None to detect it from the object content
+    :param output: type of the returned object, 'pandas' or 'arrow'
+    :param download_chunk_size: size in bytes of the byte ranges large objects are split into
+    :param download_concurrency: maximum number of byte ranges downloaded at the same time
+    :param local_path: local file to download the object to, then read through a memory map,
+        feather files are read without copy to the heap, an existing file is replaced by a new one,
+        objects read from it before keeping their content
+    :param memory: 'compact' to downcast numeric columns, and read strings as categoricals or arrow-backed strings,
+        dtypes of csv string columns being inferred from a sample, None by default, ignored with output 'arrow'
+    :param compression: file compression used, one of COMPRESSIONS, by default it is inferred
+        from the object ContentEncoding, then from the object magic bytes,
+        other codecs (i.e bz2, zip or xz) being passed to pandas reading methods
+    :param scheduler: TransferScheduler of the S3 requests, pandas_aws.transfer.DEFAULT_SCHEDULER by default
+    :param timeout: maximum duration of the download in seconds, None for no limit
+    :param '**kwargs': used for passing arguments to pandas reading methods,
+        or to pyarrow.parquet.read_table for parquet files with output 'arrow'
     :return: DataFrame from data in S3
-    :rtype: pandas.DataFrame
+    :rtype: pandas.DataFrame or pyarrow.Table
     """
 
-    assert format in ['csv', 'parquet', 'pickle', 'xlsx'], \
+    assert format in [None, 'csv', 'parquet', 'pickle', 'xlsx', 'feather'], \
         'provider format value not accepted'
+    assert output in ['pandas', 'arrow'], \
+        'provider output value not accepted'
+
+    compression = _pop_compression(kwargs)
+    scheduler = kwargs.pop('scheduler', DEFAULT_SCHEDULER)
+    deadline = scheduler.deadline(kwargs.pop('timeout', None))
+    memory = kwargs.pop('memory', None)
+    assert memory in [None, 'compact'], 'provider memory value not accepted'
 
-    object_ = s3.get_object(Bucket=bucket, Key=key)
+    data, object_ = _download_object(s3, bucket, key,
+                                     chunk_size=download_chunk_size,
+                                     max_concurrency=download_concurrency,
+                                     local_path=local_path,
+                                     scheduler=scheduler,
+                                     deadline=deadline)
+    data = _decompress(data, compression, object_.get('ContentEncoding'), object_.get('Metadata'))
+    if format is None:
+        format = _sniff_format(data)
+    return _parse_df(data, format, output=output, memory=memory, **kwargs)
+
+
+def _download_object(s3: 'boto3.resources.base.ServiceResource',
+                     bucket: str,
+                     key: str,
+                     chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                     max_concurrency: int = DOWNLOAD_CONCURRENCY,
+                     local_path: str = None,
+                     scheduler=DEFAULT_SCHEDULER,
+                     deadline: float = None) -> tuple:
+    """
+    Download the whole content of an S3 object, large objects are split into
+    byte ranges downloaded concurrently into a single preallocated buffer
+    :param s3: S3 client
+    :param bucket: bucket name of the target file
+    :param key: aws key of the target file
+    :param chunk_size: size in bytes of each byte range
+    :param max_concurrency: maximum number of byte ranges downloaded at the same time
+    :param local_path: local file to download the object to, its content is then
+        memory-mapped instead of being held in memory, an existing file is replaced, not overwritten
+    :param scheduler: TransferScheduler of the S3 requests
+    :param deadline: time.monotonic() value after which the download is abandoned, None for no deadline
+    :return: object content, and the get_object response of its first byte range
+    :rtype: tuple
+    """
+    from botocore.exceptions import ClientError
+
+    assert chunk_size > 0, 'Download chunk size not accepted, it must be > 0'
+
+    prefix = _key_prefix(bucket, key)
+    # set by the first request, once the object size is known
+    buffer, view, tmp_path = None, None, None
+
+    def allocate(size):
+        nonlocal buffer, view, tmp_path
+        if local_path is None:
+            # a writable buffer lets parsers build arrays on top of it without copy
+            buffer = bytearray(size)
+        else:
+            # the object is downloaded to a new file, moved to local_path once complete, so that objects read
+            # from a previous download to the same path keep mapping the file they were read from
+            fd, tmp_path = tempfile.mkstemp(dir=path.dirname(path.abspath(local_path)),
+                                            prefix=f'.{path.basename(local_path)}.', suffix='.part')
+            with open(fd, 'w+b') as file:
+                file.truncate(size)
+                buffer = mmap.mmap(file.fileno(), size) if size > 0 else b''
+        view = memoryview(buffer)
+
+    def read(body, start, end):
+        while start < end:
+            chunk = body.read(min(end - start, 1024 ** 2))
+            if len(chunk) == 0:
+                raise IOError(f'Incomplete download of s3://{bucket}/{key}')
+            view[start:start + len(chunk)] = chunk
+            start += len(chunk)
+
+    # requests are accounted by the scheduler until their body is read, not only until they are answered
+    def get_first():
+        try:
+            response = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes=0-{chunk_size - 1}')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            # empty objects can't be requested by range
+            response = s3.get_object(Bucket=bucket, Key=key)
+        if 'ContentRange' in response:
+            size = int(response['ContentRange'].split('/')[-1])
+            end = min(chunk_size, size)
+        else:
+            # the whole object was returned at once
+            size = end = response['ContentLength']
+        if buffer is None:
+            allocate(size)
+        read(response['Body'], 0, end)
+        return response, size, end
+
+    def get_range(start):
+        # IfMatch ensures all ranges come from the same version of the object
+        end = min(start + chunk_size, size)
+        body = s3.get_object(Bucket=bucket, Key=key, IfMatch=first['ETag'], Range=f'bytes={start}-{end - 1}')['Body']
+        read(body, start, end)
+
+    def close():
+        view.release()
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+
+    try:
+        first, size, first_end = scheduler.call(prefix, get_first, deadline=deadline)
+        if first_end < size:
+            logger.info(f'Downloading {size} bytes using {-(-size // chunk_size)} byte ranges')
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                futures = [executor.submit(scheduler.call, prefix, get_range, start, deadline=deadline)
+                           for start in range(first_end, size, chunk_size)]
+                for future in futures:
+                    future.result()
+    except BaseException:
+        if tmp_path is not None:
+            close()
+            os.remove(tmp_path)
+        raise
+
+    if local_path is None:
+        return buffer, first
+
+    close()
+    os.replace(tmp_path, local_path)
+    if size == 0:
+        return b'', first
+    # copy-on-write mapping, pages are loaded on access and never written back
+    with open(local_path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY), first
+
+
+def _sniff_format(data: bytes) -> str:
+    """
+    Identify the file format of an object from its leading bytes
+    :param data: object content, only the first bytes are used
+    :return: file format, 'csv' when no binary format matched
+    :rtype: str
+    """
+    if data[:4] == b'PAR1':
+        return 'parquet'
+    elif data[:6] == b'ARROW1':
+        # arrow IPC file, i.e feather v2
+        return 'feather'
+    elif data[:4] == b'PK\x03\x04':
+        # xlsx files are zip archives
+        return 'xlsx'
+    elif len(data) > 1 and data[0] == 0x80 and 2 <= data[1] <= pickle.HIGHEST_PROTOCOL:
+        # PROTO opcode followed by the protocol version
+        return 'pickle'
+    return 'csv'
+
+
+def _parse_df(data, format: str, output: str = 'pandas', memory: str = None, **kwargs):
+    """
+    Convert the content of an S3 object to a DataFrame
+    :param data: object content, bytes-like object read without copy
+    :param format: file format of the object, i.e csv
+    :param output: type of the returned object, 'pandas' or 'arrow'
+    :param memory: 'compact' to build a memory-optimized DataFrame, see _compact_df
+    :param '**kwargs': used for passing arguments to pandas reading methods
+    :return: DataFrame from data
+    :rtype: pandas.DataFrame or pyarrow.Table
+    """
+    import pandas
+    import pyarrow
+
+    if format == 'parquet' and output == 'arrow':
+        # no pandas round-trip, arrow reads directly from the downloaded buffer
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(pyarrow.BufferReader(data), **kwargs)
+    elif format == 'feather':
+        # uncompressed columns are not copied, they stay in the downloaded buffer
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(pyarrow.BufferReader(data), **kwargs)
+        if output == 'arrow':
+            return table
+        # split blocks keeps columns without nulls as views on arrow memory
+        df = table.to_pandas(split_blocks=True)
+        return _compact_df(df) if memory == 'compact' else df
 
     if format == 'pickle':
-        return pickle.loads(object_['Body'].read(), **kwargs)
+        df = _load_pickle(data, **kwargs)
     elif format == 'csv':
-        return pandas.read_csv(object_['Body'], **kwargs)
+        if memory == 'compact' and output == 'pandas' and not ('dtype' in kwargs and
+                                                               not isinstance(kwargs['dtype'], dict)):
+            # string columns are parsed to their compact dtype, without python str objects for most of them
+            kwargs['dtype'] = dict(_infer_csv_dtypes(data, **kwargs), **(kwargs.get('dtype') or {}))
+        df = pandas.read_csv(pyarrow.BufferReader(data), **kwargs)
     elif format == 'parquet':
-        return pandas.read_parquet(BytesIO(object_['Body'].read()), **kwargs)
+        if kwargs.get('engine') == 'fastparquet':
+            df = pandas.read_parquet(BytesIO(data), **kwargs)
+        else:
+            df = pandas.read_parquet(pyarrow.BufferReader(data), **kwargs)
     elif format == 'xlsx':
-        return pandas.read_excel(BytesIO(object_['Body'].read()), **kwargs)
+        df = pandas.read_excel(pyarrow.BufferReader(data), **kwargs)
+        if isinstance(df, dict):
+            # sheet_name=None reads all the sheets, i.e those of a split DataFrame
+            df = pandas.concat(df.values(), axis=0, ignore_index=True)
+
+    if output == 'arrow':
+        return _df_to_arrow(df)
+    if memory == 'compact':
+        return _compact_df(df)
+    return df
 
 
-def get_df_from_keys(s3: boto3.resources.base.ServiceResource,
+def get_df_from_keys(s3: 'boto3.resources.base.ServiceResource',
                      bucket: str,
                      prefix: str,
                      suffix: str = '',
@@ -252,7 +1159,16 @@ def get_df_from_keys(s3: boto3.resources.base.ServiceResource,
     :param prefix: aws key of the target file
     :param suffix: suffix to match when looking for files
     :param format: file format to get DataFrame from, i.e csv
-    :rtype: pandas.DataFrame
+    :param output: type of the returned object, 'pandas' or 'arrow'
+    :param download_chunk_size: size in bytes of the byte ranges large objects are split into
+    :param download_concurrency: maximum number of files, and of byte ranges of each file, downloaded at the same time
+    :param scheduler: TransferScheduler of the S3 requests, pandas_aws.transfer.DEFAULT_SCHEDULER by default
+    :param timeout: maximum duration of the listing and downloads in seconds, None for no limit
+    :param memory: 'compact' to downcast numeric columns, and build strings as categoricals or arrow-backed strings,
+        None by default, ignored with output 'arrow'
+    :return: DataFrame with the unified schema of all files, missing columns are filled with nulls,
+        or an in-memory pyarrow.dataset.Dataset over the files content with output 'arrow'
+    :rtype: pandas.DataFrame or pyarrow.dataset.Dataset
     """
 
     if 'format' in kwargs.keys():
@@ -260,35 +1176,60 @@ def get_df_from_keys(s3: boto3.resources.base.ServiceResource,
         del kwargs['format']
     else:
         format = 'suffix'
-    assert format in ["csv", "parquet", "xlsx", "suffix", "mixed"], f"{format} format not supported"
+    assert format in ["csv", "parquet", "xlsx", "feather", "suffix", "mixed"], f"{format} format not supported"
     if format == "mixed":
         logger.warning('Mixed format used, might discard files')
+    elif format == "suffix":
+        logger.warning('Auto format detection based on suffix used')
 
-    l_df = list()
-    for f in get_keys(s3, bucket, prefix=prefix, suffix=suffix):
-        if f != prefix:
-            if format == 'suffix':
-                logger.warning('Auto format detection based on suffix used')
-                format = f.split('.')[-1]
-                obj_ = get_df(s3, bucket, f, format, **kwargs)
-                l_df.append(obj_)
-            elif format == 'mixed':
-                processed = False
-                for format_ in ['csv', 'parquet', 'xlsx']:
-                    try:
-                        obj_ = get_df(s3, bucket, f, format_, **kwargs)
-                        l_df.append(obj_)
-                        processed = True
-                    except Exception:
-                        pass
-                if processed == False:
-                    logger.warning(f'No format matched for file {f}')
-            else:
-                obj_ = get_df(s3, bucket, f, format, **kwargs)
-                l_df.append(obj_)
-
-    if len(l_df) > 0:
-        return pandas.concat(l_df, axis=0, ignore_index=True) \
-                     .reset_index(drop=True)
+    if 'output' in kwargs.keys():
+        output = kwargs['output']
+        del kwargs['output']
     else:
+        output = 'pandas'
+    assert output in ['pandas', 'arrow'], f"{output} output not supported"
+
+    download_chunk_size = kwargs.pop('download_chunk_size', DOWNLOAD_CHUNK_SIZE)
+    download_concurrency = kwargs.pop('download_concurrency', DOWNLOAD_CONCURRENCY)
+    compression = _pop_compression(kwargs)
+    scheduler = kwargs.pop('scheduler', DEFAULT_SCHEDULER)
+    deadline = scheduler.deadline(kwargs.pop('timeout', None))
+    memory = kwargs.pop('memory', None)
+    assert memory in [None, 'compact'], f"{memory} memory not supported"
+
+    def fetch(f):
+        # each object is downloaded once, then sent to a single parser
+        data, object_ = _download_object(s3, bucket, f,
+                                         chunk_size=download_chunk_size,
+                                         max_concurrency=download_concurrency,
+                                         scheduler=scheduler,
+                                         deadline=deadline)
+        data = _decompress(data, compression, object_.get('ContentEncoding'), object_.get('Metadata'))
+        if format in ['suffix', 'mixed']:
+            format_ = f.split('.')[-1] if format == 'suffix' else None
+            if format_ not in ['csv', 'parquet', 'pickle', 'xlsx', 'feather']:
+                if format == 'suffix':
+                    logger.warning(f'Unknown suffix for file {f}, using format detection')
+                format_ = _sniff_format(data)
+        else:
+            format_ = format
+        try:
+            return _parse_df(data, format_, output='arrow', **kwargs)
+        except Exception as e:
+            if format != 'mixed':
+                raise
+            logger.warning(f'No format matched for file {f}: {e}')
+
+    keys = [f for f in get_keys(s3, bucket, prefix=prefix, suffix=suffix, scheduler=scheduler, deadline=deadline)
+            if f != prefix]
+    # files are downloaded concurrently, results are kept in the keys order
+    with ThreadPoolExecutor(max_workers=max(1, min(len(keys), download_concurrency))) as executor:
+        tables = [t for t in executor.map(fetch, keys) if t is not None]
+
+    if len(tables) == 0:
         return None
+    elif output == 'arrow':
+        import pyarrow.dataset
+        return pyarrow.dataset.dataset(_unify_arrow_tables(tables))
+    else:
+        return _concat_arrow_to_df(tables, memory=memory)
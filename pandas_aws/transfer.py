@@ -0,0 +1,162 @@
+#  -*- coding: utf-8 -*-
+__author__ = 'fpajot'
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# error codes returned by AWS when the request rate must be reduced
+THROTTLING_ERROR_CODES = frozenset([
+    'SlowDown', 'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+    'ServiceUnavailable', 'BandwidthLimitExceeded', '503'])
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Checks whether an exception is a throttling response from AWS"""
+    from botocore.exceptions import ClientError
+
+    if not isinstance(error, ClientError):
+        return False
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in THROTTLING_ERROR_CODES or status == 503
+
+
+class _PrefixLimit(object):
+    """Adaptive concurrency limit of the requests sent to a single prefix"""
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        # incremented at each decrease, so that requests sent before it don't decrease the limit again
+        self.generation = 0
+        self.condition = threading.Condition()
+
+
+class TransferScheduler(object):
+    """
+    Schedules S3 requests with an AIMD (additive-increase, multiplicative-decrease) concurrency limit
+    per prefix, and retries throttled requests with exponential backoff and full jitter.
+    A single scheduler is meant to be shared, so that all the requests to a prefix are accounted together.
+    Throttled requests are only seen by the scheduler once botocore gave up retrying them, thus the clients used
+    with a scheduler should disable botocore retries, otherwise each scheduler attempt is retried by botocore:
+
+        get_client('s3', config=botocore.config.Config(retries={'max_attempts': 1}))
+    """
+
+    def __init__(self,
+                 initial_concurrency: int = 8,
+                 min_concurrency: int = 1,
+                 max_concurrency: int = 64,
+                 max_attempts: int = 10,
+                 base_delay: float = 0.05,
+                 max_delay: float = 20.0,
+                 decrease_factor: float = 0.5):
+        """
+        :param initial_concurrency: concurrency limit of a prefix before any response
+        :param min_concurrency: lowest concurrency limit of a prefix
+        :param max_concurrency: highest concurrency limit of a prefix
+        :param max_attempts: maximum number of attempts of a throttled request
+        :param base_delay: delay in seconds of the first retry, doubled at each attempt
+        :param max_delay: maximum delay in seconds between two attempts
+        :param decrease_factor: factor applied to the concurrency limit of a throttled prefix
+        """
+        assert 0 < min_concurrency <= initial_concurrency <= max_concurrency, \
+            'Concurrency not accepted, it must be 0 < min_concurrency <= initial_concurrency <= max_concurrency'
+        assert max_attempts > 0, 'Number of attempts not accepted, it must be > 0'
+        assert 0 < decrease_factor < 1, 'Decrease factor not accepted, it must be between 0 and 1'
+
+        self.initial_concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.decrease_factor = decrease_factor
+
+        self._lock = threading.Lock()
+        self._limits = {}
+
+    def _get_limit(self, prefix: str) -> _PrefixLimit:
+        with self._lock:
+            if prefix not in self._limits:
+                self._limits[prefix] = _PrefixLimit(float(self.initial_concurrency))
+            return self._limits[prefix]
+
+    def concurrency(self, prefix: str) -> int:
+        """Current concurrency limit of a prefix"""
+        return int(self._get_limit(prefix).limit)
+
+    @staticmethod
+    def deadline(timeout: float = None) -> float:
+        """Converts an operation timeout in seconds to a deadline, None if there is no timeout"""
+        return None if timeout is None else time.monotonic() + timeout
+
+    @staticmethod
+    def _check_deadline(deadline: float, error: Exception = None) -> None:
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError('S3 operation deadline exceeded') from error
+
+    def _acquire(self, limit: _PrefixLimit, deadline: float) -> int:
+        with limit.condition:
+            while limit.in_flight >= int(limit.limit):
+                self._check_deadline(deadline)
+                limit.condition.wait(None if deadline is None else deadline - time.monotonic())
+            limit.in_flight += 1
+            return limit.generation
+
+    def _release(self, limit: _PrefixLimit, generation: int, throttled: bool, succeeded: bool) -> None:
+        with limit.condition:
+            limit.in_flight -= 1
+            if throttled:
+                if generation == limit.generation:
+                    limit.limit = max(float(self.min_concurrency), limit.limit * self.decrease_factor)
+                    limit.generation += 1
+                    logger.info(f'Throttled, concurrency decreased to {int(limit.limit)}')
+            elif succeeded:
+                # the limit increases by about one for each limit of successful requests
+                limit.limit = min(float(self.max_concurrency), limit.limit + 1 / limit.limit)
+            limit.condition.notify_all()
+
+    def call(self, prefix: str, func, *args, deadline: float = None, **kwargs):
+        """
+        Calls a function sending an S3 request, within the concurrency limit of the prefix,
+        retrying it while it is throttled, the function should read the response body for the whole
+        transfer to be accounted
+        :param prefix: prefix of the requested keys, including the bucket name
+        :param func: function sending the request
+        :param deadline: time.monotonic() value after which the request is abandoned, None for no deadline
+        :param '*args, **kwargs': used for passing arguments to func
+        :return: func result
+        """
+        limit = self._get_limit(prefix)
+        attempt = 0
+        while True:
+            self._check_deadline(deadline)
+            generation = self._acquire(limit, deadline)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                # other errors, i.e missing keys, tell nothing about the request rate the prefix supports
+                throttled = is_throttling_error(e)
+                self._release(limit, generation, throttled, False)
+                attempt += 1
+                if not throttled or attempt >= self.max_attempts:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    raise TimeoutError('S3 operation deadline exceeded') from e
+                logger.debug(f'Throttled on {prefix}, retrying in {delay:.3f}s')
+                time.sleep(delay)
+            else:
+                self._release(limit, generation, False, True)
+                return result
+
+
+# scheduler shared by the functions of pandas_aws.s3 when none is provided
+DEFAULT_SCHEDULER = TransferScheduler()
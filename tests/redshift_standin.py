@@ -0,0 +1,331 @@
+#  -*- coding: utf-8 -*-
+__author__ = 'fpajot'
+
+from collections import Counter
+import csv
+import gzip
+import io
+import json
+import re
+import sqlite3
+import threading
+import time
+
+# Redshift types as returned by format_type(), from the sqlite declared types
+CATALOG_TYPES = {
+    'integer': 'integer',
+    'int': 'integer',
+    'bigint': 'bigint',
+    'smallint': 'smallint',
+    'real': 'real',
+    'float': 'double precision',
+    'boolean': 'boolean',
+    'timestamp': 'timestamp without time zone',
+    'datetime': 'timestamp without time zone',
+    'date': 'date',
+}
+
+_COPY = re.compile(r"COPY\s+(?P<table>[\w.]+)\s*\((?P<columns>[^)]*)\)\s*FROM\s+'(?P<url>[^']*)'(?P<options>.*)",
+                   re.IGNORECASE | re.DOTALL)
+_UNLOAD = re.compile(r"UNLOAD\s*\(\s*'(?P<query>(?:[^']|'')*)'\s*\)\s*TO\s+'(?P<url>[^']*)'(?P<options>.*)",
+                     re.IGNORECASE | re.DOTALL)
+_CREATE = re.compile(r'CREATE\s+(?P<temp>TEMP(?:ORARY)?\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(?P<table>[\w.]+)',
+                     re.IGNORECASE)
+_CREATE_LIKE = re.compile(r'CREATE\s+TEMP(?:ORARY)?\s+TABLE\s+(?P<table>\w+)\s*\(\s*LIKE\s+(?P<source>[\w.]+)\s*\)',
+                          re.IGNORECASE)
+_DROP = re.compile(r'DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?P<table>[\w.]+)', re.IGNORECASE)
+_DELETE_USING = re.compile(r'DELETE\s+FROM\s+(?P<table>[\w.]+)\s+USING\s+(?P<source>[\w.]+)\s+WHERE\s+(?P<condition>.*)',
+                           re.IGNORECASE | re.DOTALL)
+_INSERT_SELECT = re.compile(r'INSERT\s+INTO\s+(?P<table>[\w.]+)\s+SELECT\s+\*\s+FROM\s+(?P<source>[\w.]+)\s*$',
+                            re.IGNORECASE)
+_TABLE_OPTIONS = re.compile(r'\s+(?:DISTSTYLE\s+\w+|DISTKEY\s*\([^)]*\)|(?:INTERLEAVED\s+|COMPOUND\s+)?SORTKEY\s*\([^)]*\))',
+                            re.IGNORECASE)
+
+
+def split_statements(query: str) -> list:
+    """Splits a query text into its statements, semicolons within quoted strings being kept"""
+    statements = []
+    current = []
+    quote = None
+    for c in query:
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+        elif c == ';':
+            statements.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(c)
+    statements.append(''.join(current).strip())
+    return [s for s in statements if s]
+
+
+def statement_kind(statement: str) -> str:
+    """Classifies a statement as ddl, copy, unload, delete, insert, select, catalog or transaction"""
+    words = statement.split(None, 2)
+    first = words[0].upper() if words else ''
+    if first in ['CREATE', 'DROP', 'ALTER']:
+        return 'ddl'
+    if first in ['BEGIN', 'END', 'COMMIT', 'ROLLBACK']:
+        return 'transaction'
+    if first == 'SELECT' and 'pg_attribute' in statement:
+        return 'catalog'
+    return first.lower()
+
+
+class StandInConnector(object):
+    """
+    Local stand-in of a Redshift connection, backed by an in-memory sqlite database.
+    The statements emitted by RedshiftClient are translated to sqlite: COPY and UNLOAD read and write
+    S3 objects through an S3 client (i.e a moto one), Redshift table options are ignored but
+    distribution and sort keys, which are reported with the columns by catalog queries answered from the sqlite tables.
+    Executed statements are counted and timed by kind, in the counts and durations attributes.
+    """
+
+    def __init__(self, s3_client, latency: float = 0.):
+        """
+        :param s3_client: S3 client used by COPY and UNLOAD statements
+        :param latency: delay in seconds added to each cursor.execute() call, simulating the network round trip
+        """
+        self.s3_client = s3_client
+        self.latency = latency
+        # autocommit, transactions are started by BEGIN statements only
+        self.connection = sqlite3.connect(':memory:', isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.schemas = {'main'}
+        # unqualified table name to (distribution key columns, sort key columns)
+        self.table_keys = {}
+        self.counts = Counter()
+        self.durations = Counter()
+        self.round_trips = 0
+        self.commits = 0
+
+    def cursor(self, name: str = None) -> 'StandInCursor':
+        return StandInCursor(self, name)
+
+    def commit(self) -> None:
+        with self.lock:
+            self.commits += 1
+            if self.connection.in_transaction:
+                self.connection.execute('COMMIT')
+
+    def rollback(self) -> None:
+        with self.lock:
+            if self.connection.in_transaction:
+                self.connection.execute('ROLLBACK')
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def reset_stats(self) -> None:
+        """Forgets the statement counts and durations"""
+        with self.lock:
+            self.counts.clear()
+            self.durations.clear()
+            self.round_trips = 0
+            self.commits = 0
+
+    def _attach(self, table: str) -> None:
+        """Attaches an in-memory database for the schema of a qualified table name"""
+        if '.' in table:
+            schema = table.split('.', 1)[0].lower()
+            if schema not in self.schemas:
+                self.connection.execute(f"ATTACH DATABASE ':memory:' AS {schema}")
+                self.schemas.add(schema)
+
+    def table_columns(self, table: str) -> list:
+        """Retrieves the (column, declared type) list of a table, empty if the table doesn't exist"""
+        if '.' in table:
+            schema, table = table.lower().split('.', 1)
+            if schema not in self.schemas:
+                return []
+            rows = self.connection.execute(f'PRAGMA {schema}.table_info({table})').fetchall()
+        else:
+            rows = self.connection.execute(f'PRAGMA table_info({table})').fetchall()
+        return [(r[1], r[2]) for r in rows]
+
+    @staticmethod
+    def _catalog_type(declared: str) -> str:
+        declared = declared.lower()
+        if declared.startswith('varchar'):
+            return 'character varying' + declared[len('varchar'):]
+        return CATALOG_TYPES.get(declared, declared)
+
+    def _read_objects(self, url: str, manifest: bool) -> list:
+        """Retrieves the content of the S3 objects listed by a COPY source"""
+        if manifest:
+            urls = [e['url'] for e in json.loads(self._get_object(url))['entries']]
+        else:
+            bucket, prefix = url[len('s3://'):].split('/', 1)
+            response = self.s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+            urls = [f"s3://{bucket}/{o['Key']}" for o in response.get('Contents', [])]
+        return [self._get_object(u) for u in urls]
+
+    def _get_object(self, url: str) -> bytes:
+        bucket, key = url[len('s3://'):].split('/', 1)
+        return self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    @staticmethod
+    def _option(options: str, name: str, default: str = None) -> str:
+        match = re.search(rf"\b{name}\s+(?:AS\s+)?'([^']*)'", options, re.IGNORECASE)
+        return match.group(1) if match else default
+
+    @staticmethod
+    def _flag(options: str, name: str) -> bool:
+        return re.search(rf'\b{name}\b', options, re.IGNORECASE) is not None
+
+    def _copy(self, match) -> None:
+        table, options = match.group('table'), match.group('options')
+        columns = [c.strip() for c in match.group('columns').split(',')]
+        delimiter = self._option(options, 'DELIMI?ETER', '|')
+        quotechar = self._option(options, 'QUOTE', '"')
+        header = re.search(r'\bIGNOREHEADER\s+(\d+)', options, re.IGNORECASE)
+        header = int(header.group(1)) if header else 0
+
+        rows = []
+        for data in self._read_objects(match.group('url'), self._flag(options, 'MANIFEST')):
+            if self._flag(options, 'GZIP'):
+                data = gzip.decompress(data)
+            reader = csv.reader(io.StringIO(data.decode('utf-8')), delimiter=delimiter, quotechar=quotechar)
+            for i, row in enumerate(reader):
+                if i >= header:
+                    # empty fields are loaded as NULL
+                    rows.append([v if v != '' else None for v in row])
+        self.connection.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})", rows)
+
+    def _unload(self, match) -> None:
+        options = match.group('options')
+        cursor = self.connection.execute(self.translate(match.group('query').replace("''", "'"))[0])
+        delimiter = self._option(options, 'DELIMITER', ',' if self._flag(options, 'CSV') else '|')
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=delimiter, lineterminator='\n')
+        if self._flag(options, 'HEADER'):
+            writer.writerow([c[0] for c in cursor.description])
+        writer.writerows(cursor.fetchall())
+        data = buffer.getvalue().encode('utf-8')
+
+        # files are named as unloaded with PARALLEL OFF
+        url = match.group('url') + '000'
+        if self._flag(options, 'GZIP'):
+            data, url = gzip.compress(data), url + '.gz'
+        bucket, key = url[len('s3://'):].split('/', 1)
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+        if self._flag(options, 'MANIFEST'):
+            self.s3_client.put_object(Bucket=bucket, Key=match.group('url')[len(f's3://{bucket}/'):] + 'manifest',
+                                      Body=json.dumps({'entries': [{'url': url}]}).encode('utf-8'))
+
+    def translate(self, statement: str) -> list:
+        """Translates a Redshift statement to sqlite statements"""
+        match = _CREATE_LIKE.match(statement)
+        if match:
+            columns = self.table_columns(match.group('source'))
+            return [f"CREATE TEMP TABLE {match.group('table')} ({', '.join(f'{c} {t}' for c, t in columns)})"]
+        match = _CREATE.match(statement) or _DROP.match(statement)
+        if match:
+            self._attach(match.group('table'))
+            if statement.upper().startswith('CREATE'):
+                distkey = re.search(r'\bDISTKEY\s*\(([^)]*)\)', statement, re.IGNORECASE)
+                sortkey = re.search(r'\bSORTKEY\s*\(([^)]*)\)', statement, re.IGNORECASE)
+                self.table_keys[match.group('table').split('.')[-1].lower()] = (
+                    [c.strip() for c in distkey.group(1).split(',')] if distkey else [],
+                    [c.strip() for c in sortkey.group(1).split(',')] if sortkey else [])
+            statement = re.sub(r'\bGETDATE\(\)|\bSYSDATE\b', 'CURRENT_TIMESTAMP', statement, flags=re.IGNORECASE)
+            statement = re.sub(r'\s+CASCADE\s*$', '', _TABLE_OPTIONS.sub('', statement), flags=re.IGNORECASE)
+            return [statement]
+        match = _DELETE_USING.match(statement)
+        if match:
+            table, source, condition = match.group('table'), match.group('source'), match.group('condition')
+            equalities = [e.strip() for e in re.split(r'\s+AND\s+', condition.strip(), flags=re.IGNORECASE)]
+            pairs = [re.fullmatch(rf'{re.escape(table)}\.(\w+)\s*=\s*{re.escape(source)}\.(\w+)', e) for e in equalities]
+            if all(pairs):
+                # a row value IN subquery is indexed by sqlite, unlike a correlated EXISTS subquery
+                return [f"DELETE FROM {table} WHERE ({', '.join(p.group(1) for p in pairs)}) IN "
+                        f"(SELECT {', '.join(p.group(2) for p in pairs)} FROM {source})"]
+            return [f'DELETE FROM {table} WHERE EXISTS (SELECT 1 FROM {source} WHERE {condition})']
+        match = _INSERT_SELECT.match(statement)
+        if match:
+            # Redshift fills the missing trailing columns with their default, sqlite needs them listed
+            columns = ', '.join(c for c, _ in self.table_columns(match.group('source')))
+            return [f"INSERT INTO {match.group('table')} ({columns}) SELECT {columns} FROM {match.group('source')}"]
+        upper = statement.upper()
+        if upper.startswith('BEGIN'):
+            return [] if self.connection.in_transaction else ['BEGIN']
+        if upper.startswith('END'):
+            return ['COMMIT'] if self.connection.in_transaction else []
+        return [statement]
+
+
+class StandInCursor(object):
+    """Cursor of a StandInConnector, following the psycopg2 cursor interface used by RedshiftClient"""
+
+    def __init__(self, connector: StandInConnector, name: str = None):
+        self.connector = connector
+        self.name = name
+        self.itersize = 2000
+        self.closed = False
+        self._cursor = None
+        self._rows = None
+
+    @property
+    def description(self):
+        if self._rows is not None:
+            return [('attname',), ('format_type',), ('attisdistkey',), ('attsortkeyord',)]
+        return None if self._cursor is None else self._cursor.description
+
+    def execute(self, query: str, parameters: tuple = None) -> None:
+        connector = self.connector
+        with connector.lock:
+            connector.round_trips += 1
+            if connector.latency > 0:
+                time.sleep(connector.latency)
+            self._cursor, self._rows = None, None
+            for statement in split_statements(query):
+                kind = statement_kind(statement)
+                start = time.perf_counter()
+                try:
+                    self._execute(statement, kind, parameters)
+                finally:
+                    connector.counts[kind] += 1
+                    connector.durations[kind] += time.perf_counter() - start
+
+    def _execute(self, statement: str, kind: str, parameters: tuple) -> None:
+        connector = self.connector
+        if kind == 'catalog':
+            # parameters are the table name, preceded by the schema name of qualified names
+            table = '.'.join(parameters)
+            distkey, sortkey = connector.table_keys.get(parameters[-1], ([], []))
+            self._rows = [(c, connector._catalog_type(t), c in distkey, sortkey.index(c) + 1 if c in sortkey else 0)
+                          for c, t in connector.table_columns(table)]
+            return
+        match = _COPY.match(statement)
+        if match:
+            connector._copy(match)
+            return
+        match = _UNLOAD.match(statement)
+        if match:
+            connector._unload(match)
+            return
+        for translated in connector.translate(statement):
+            if parameters is not None:
+                self._cursor = connector.connection.execute(translated.replace('%s', '?'), parameters)
+            else:
+                self._cursor = connector.connection.execute(translated)
+
+    def fetchall(self) -> list:
+        return self.fetchmany(None)
+
+    def fetchmany(self, size: int = None) -> list:
+        if self._rows is not None:
+            rows = self._rows if size is None else self._rows[:int(size)]
+            self._rows = self._rows[len(rows):]
+            return rows
+        if self._cursor is None:
+            return []
+        with self.connector.lock:
+            return self._cursor.fetchall() if size is None else self._cursor.fetchmany(int(size))
+
+    def close(self) -> None:
+        self.closed = True
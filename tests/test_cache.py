@@ -0,0 +1,72 @@
+#  -*- coding: utf-8 -*-
+__author__ = 'fpajot'
+
+import tempfile
+from unittest import TestCase
+
+import mock
+import pandas
+import pyarrow
+
+from pandas_aws.cache import ResultCache
+
+
+class ResultCacheTests(TestCase):
+    """Test for ResultCache"""
+
+    def setUp(self):
+        self.df = pandas.DataFrame({'col_1': [1, 2], 'col_2': ['a', 'b']})
+
+    def test_key_normalizes_query(self):
+        cache = ResultCache()
+        self.assertEqual(cache.key('SELECT *\n  FROM table;'), cache.key(' SELECT * FROM table '))
+        self.assertNotEqual(cache.key('SELECT * FROM table'), cache.key('SELECT * FROM table', output='arrow'))
+        # whitespaces within quoted strings are part of the query
+        self.assertNotEqual(cache.key("SELECT * FROM table WHERE n = 'a  b'"),
+                            cache.key("SELECT * FROM table WHERE n = 'a b'"))
+
+    def test_get_returns_copy(self):
+        cache = ResultCache()
+        cache.set('key', self.df)
+        df = cache.get('key')
+        df['col_1'] = 0
+        pandas.testing.assert_frame_equal(self.df, cache.get('key'))
+
+    def test_lru_eviction(self):
+        cache = ResultCache(maxsize=2)
+        cache.set('key_1', self.df)
+        cache.set('key_2', self.df)
+        cache.get('key_1')
+        cache.set('key_3', self.df)
+        self.assertIsNotNone(cache.get('key_1'))
+        self.assertIsNone(cache.get('key_2'))
+
+    def test_ttl_expiration(self):
+        cache = ResultCache(ttl=10)
+        with mock.patch('pandas_aws.cache.time.time', return_value=1000):
+            cache.set('key', self.df)
+        with mock.patch('pandas_aws.cache.time.time', return_value=1005):
+            self.assertIsNotNone(cache.get('key'))
+        with mock.patch('pandas_aws.cache.time.time', return_value=1011):
+            self.assertIsNone(cache.get('key'))
+
+    def test_invalidate_by_table(self):
+        cache = ResultCache()
+        cache.set('key_1', self.df, tables=['schema.table_1'])
+        cache.set('key_2', self.df, tables=['table_2'])
+        cache.invalidate(table='TABLE_1')
+        self.assertIsNone(cache.get('key_1'))
+        cache.invalidate(table='schema.table_2')
+        self.assertIsNone(cache.get('key_2'))
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            ResultCache(cache_dir=cache_dir).set('key_1', self.df, tables=['table'])
+            ResultCache(cache_dir=cache_dir).set('key_2', pyarrow.Table.from_pandas(self.df))
+            cache = ResultCache(cache_dir=cache_dir)
+            pandas.testing.assert_frame_equal(self.df, cache.get('key_1'))
+            self.assertIsInstance(cache.get('key_2'), pyarrow.Table)
+            ResultCache(cache_dir=cache_dir).invalidate(table='table')
+            self.assertIsNone(ResultCache(cache_dir=cache_dir).get('key_1'))
+            ResultCache(cache_dir=cache_dir).invalidate()
+            self.assertIsNone(ResultCache(cache_dir=cache_dir).get('key_2'))
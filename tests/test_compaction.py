@@ -0,0 +1,102 @@
+#  -*- coding: utf-8 -*-
+__author__ = 'fpajot'
+
+import gzip
+import io
+import json
+from unittest import TestCase
+
+import boto3
+import mock
+from moto import mock_s3
+import numpy
+import pandas
+
+from pandas_aws.compaction import compact, main
+from pandas_aws.s3 import get_df, get_df_from_keys, get_keys
+
+MY_BUCKET = "mymockbucket"
+MY_PREFIX = "mockfolder"
+AWS_REGION_NAME = 'eu-west-1'
+
+
+@mock_s3
+class CompactTests(TestCase):
+    """Test for compaction.compact"""
+
+    def setUp(self):
+        self.client = boto3.client("s3", region_name=AWS_REGION_NAME)
+        s3 = boto3.resource("s3", region_name=AWS_REGION_NAME)
+        s3.create_bucket(Bucket=MY_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION_NAME})
+        self.df = pandas.DataFrame({'col_1': numpy.arange(200)[::-1], 'col_2': numpy.arange(200) * 0.5})
+        for i, part in enumerate(numpy.array_split(self.df, 20)):
+            body = part.to_csv(index=False).encode('utf-8')
+            if i % 2:
+                self.client.put_object(Bucket=MY_BUCKET, Key=f'{MY_PREFIX}/src/key{i}.csv.gz', Body=gzip.compress(body))
+            else:
+                self.client.put_object(Bucket=MY_BUCKET, Key=f'{MY_PREFIX}/src/key{i}.csv', Body=body)
+
+    def test_compact_success(self):
+        keys = compact(self.client, MY_BUCKET, f'{MY_PREFIX}/src/', f'{MY_PREFIX}/dst', target_size_mb=0.001,
+                       sort_keys=['col_1'], concurrency=4)
+        self.assertGreater(len(keys), 1)
+        self.assertLess(len(keys), 20)
+        self.assertSequenceEqual(keys, list(get_keys(self.client, MY_BUCKET, prefix=f'{MY_PREFIX}/dst/')))
+        first = get_df(self.client, MY_BUCKET, keys[0], format='parquet')
+        self.assertTrue(first['col_1'].is_monotonic_increasing)
+        o = get_df_from_keys(self.client, MY_BUCKET, f'{MY_PREFIX}/dst/', format='parquet')
+        self.assertSequenceEqual(sorted(self.df['col_1']), sorted(o['col_1']))
+
+    def test_compact_success_with_manifest(self):
+        keys = compact(self.client, MY_BUCKET, f'{MY_PREFIX}/src/', f'{MY_PREFIX}/dst/', format='csv',
+                       compression='gzip', manifest=True)
+        self.assertSequenceEqual([f'{MY_PREFIX}/dst/part-00001.csv.gz'], keys)
+        manifest = json.loads(self.client.get_object(Bucket=MY_BUCKET, Key=f'{MY_PREFIX}/dst.manifest')['Body'].read())
+        self.assertSequenceEqual([f's3://{MY_BUCKET}/{keys[0]}'], [e['url'] for e in manifest['entries']])
+        o = get_df(self.client, MY_BUCKET, keys[0], format='csv')
+        self.assertEqual(len(self.df), len(o))
+
+    def test_main(self):
+        with mock.patch('pandas_aws.compaction.get_client', return_value=self.client), \
+                mock.patch('builtins.print') as print_:
+            main([MY_BUCKET, f'{MY_PREFIX}/src/', f'{MY_PREFIX}/dst', '--sort-keys', 'col_1,col_2'])
+        print_.assert_called_once_with(f's3://{MY_BUCKET}/{MY_PREFIX}/dst/part-00001.parquet')
+
+    def test_compact_success_without_format_suffix(self):
+        # i.e files written by Spark or Redshift UNLOAD
+        prefix = f'{MY_PREFIX}/unload/'
+        for i, part in enumerate(numpy.array_split(self.df, 3)):
+            buffer = io.BytesIO()
+            part.to_parquet(buffer, engine='pyarrow')
+            self.client.put_object(Bucket=MY_BUCKET, Key=f'{prefix}part-{i:04d}', Body=buffer.getvalue())
+        self.client.put_object(Bucket=MY_BUCKET, Key=f'{prefix}part-0003.gz',
+                               Body=gzip.compress(self.df.iloc[:10].to_csv(index=False).encode('utf-8')))
+        keys = compact(self.client, MY_BUCKET, prefix, f'{MY_PREFIX}/dst')
+        o = get_df(self.client, MY_BUCKET, keys[0], format='parquet')
+        self.assertEqual(len(self.df) + 10, len(o))
+
+    def test_compact_success_with_mismatched_schemas(self):
+        # each compacted file gets the schema of all the source files, not only of its own rows
+        prefix = f'{MY_PREFIX}/mismatched/'
+        frames = [pandas.DataFrame({'col_1': [1, 2], 'col_3': [1, 2]}), pandas.DataFrame({'col_1': [0.5], 'col_2': ['a']})]
+        for i, df in enumerate(frames):
+            buffer = io.BytesIO()
+            df.to_parquet(buffer, engine='pyarrow')
+            self.client.put_object(Bucket=MY_BUCKET, Key=f'{prefix}key{i}.parquet', Body=buffer.getvalue())
+
+        keys = compact(self.client, MY_BUCKET, prefix, f'{MY_PREFIX}/dst', target_size_mb=1e-6)
+        self.assertEqual(2, len(keys))
+        schemas = [get_df(self.client, MY_BUCKET, k, format='parquet', output='arrow').schema for k in keys]
+        self.assertSequenceEqual(['col_1', 'col_3', 'col_2'], schemas[0].names)
+        self.assertEqual('double', str(schemas[0].field('col_1').type))
+        self.assertEqual('string', str(schemas[0].field('col_2').type))
+        self.assertTrue(schemas[0].remove_metadata().equals(schemas[1].remove_metadata()))
+
+        keys = compact(self.client, MY_BUCKET, prefix, f'{MY_PREFIX}/dst_csv', target_size_mb=1e-6, format='csv')
+        headers = [get_df(self.client, MY_BUCKET, k, format='csv').columns.tolist() for k in keys]
+        self.assertSequenceEqual([['col_1', 'col_3', 'col_2']] * 2, headers)
+
+        # integers missing from some rows stay integers
+        keys = compact(self.client, MY_BUCKET, prefix, f'{MY_PREFIX}/dst_csv_1', format='csv')
+        body = self.client.get_object(Bucket=MY_BUCKET, Key=keys[0])['Body'].read().decode('utf-8')
+        self.assertSequenceEqual(['col_1,col_3,col_2', '1.0,1,', '2.0,2,', '0.5,,a'], body.splitlines())
@@ -0,0 +1,40 @@
+#  -*- coding: utf-8 -*-
+__author__ = 'fpajot'
+
+import json
+import subprocess
+import sys
+from unittest import TestCase
+
+# modules loaded only by the code paths using them
+HEAVY_MODULES = ['boto3', 'botocore', 'pandas', 'numpy', 'pyarrow', 'psycopg2', 'xlsxwriter']
+# import time budget of the whole package, in seconds
+IMPORT_TIME_BUDGET = 0.3
+
+SCRIPT = """
+import json, logging, sys, time
+start = time.perf_counter()
+import pandas_aws, pandas_aws.s3, pandas_aws.redshift, pandas_aws.cache, pandas_aws.transfer, pandas_aws.compaction
+duration = time.perf_counter() - start
+print(json.dumps({'duration': duration,
+                  'modules': [m for m in sys.modules if m.split('.')[0] in %r],
+                  'handlers': len(logging.getLogger().handlers)}))
+"""
+
+
+class ImportTimeTests(TestCase):
+    """Test for the package import cost"""
+
+    def setUp(self):
+        # a fresh interpreter, modules imported by other tests are not accounted
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT % HEAVY_MODULES])
+        self.result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    def test_import_without_heavy_modules(self):
+        self.assertSequenceEqual([], self.result['modules'])
+
+    def test_import_without_logging_configuration(self):
+        self.assertEqual(0, self.result['handlers'])
+
+    def test_import_time_budget(self):
+        self.assertLess(self.result['duration'], IMPORT_TIME_BUDGET)
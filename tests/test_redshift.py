@@ -2,16 +2,24 @@
 __author__ = 'fpajot'
 
 import io
+import json
 import logging
 import pickle
+import time
 from unittest import TestCase
 
 import boto3
 from botocore.exceptions import ClientError
+import mock
 from moto import mock_s3
 import pandas
+import pyarrow
 
+from pandas_aws.cache import ResultCache
 from pandas_aws.redshift import RedshiftClient
+import pandas_aws.s3
+
+from .redshift_standin import StandInConnector
 
 MY_BUCKET = "mymockbucket"
 MY_PREFIX = "mockfolder"
@@ -45,3 +53,470 @@ class BaseAWSTest(TestCase):
         for key in bucket.objects.all():
             key.delete()
         bucket.delete()
+
+
+class GetDFTests(TestCase):
+    """Test for RedshiftClient.get_df"""
+
+    def setUp(self):
+        self.connector = mock.MagicMock()
+        self.cursor = self.connector.cursor.return_value
+        self.cursor.description = [('col_1',), ('col_2',)]
+        self.cursor.fetchmany.side_effect = [[(3, 'a'), (2, 'b')], [(1, None)], []]
+        self.redshift = RedshiftClient(self.connector, 'schema', s3_client=None)
+
+    def test_get_df_success(self):
+        df = self.redshift.get_df('SELECT * FROM table', fetch_size=2)
+        self.assertSequenceEqual(['col_1', 'col_2'], list(df.columns))
+        self.assertSequenceEqual([3, 2, 1], df['col_1'].tolist())
+
+    def test_get_df_success_to_arrow(self):
+        table = self.redshift.get_df('SELECT * FROM table', fetch_size=2, output='arrow')
+        self.assertIsInstance(table, pyarrow.Table)
+        self.assertSequenceEqual(['col_1', 'col_2'], table.column_names)
+        self.assertSequenceEqual(['a', 'b', None], table.column('col_2').to_pylist())
+
+    def test_get_df_success_to_arrow_with_renamed_columns(self):
+        table = self.redshift.get_df('SELECT * FROM table', columns_={'col_1': 'id'}, output='arrow')
+        self.assertSequenceEqual(['id', 'col_2'], table.column_names)
+
+    def test_get_df_success_with_compact_memory(self):
+        df = self.redshift.get_df('SELECT * FROM table', fetch_size=2, memory='compact')
+        self.assertEqual('int8', df['col_1'].dtype)
+        self.assertSequenceEqual([3, 2, 1], df['col_1'].tolist())
+        self.assertEqual('string', df['col_2'].dtype)
+
+
+class GetDFCacheTests(TestCase):
+    """Test for RedshiftClient.get_df with a result cache"""
+
+    def setUp(self):
+        self.connector = mock.MagicMock()
+        self.cursor = self.connector.cursor.return_value
+        self.cursor.description = [('col_1',), ('col_2',)]
+        self.cursor.fetchmany.side_effect = lambda size: []
+        self.redshift = RedshiftClient(self.connector, 'schema', s3_client=None, result_cache=ResultCache())
+
+    def test_get_df_cached(self):
+        self.cursor.fetchmany.side_effect = [[(1, 'a')], []]
+        df = self.redshift.get_df('SELECT * FROM table', depends_on=['table'])
+        cached_df = self.redshift.get_df('SELECT *  FROM table;')
+        pandas.testing.assert_frame_equal(df, cached_df)
+        self.assertEqual(1, self.cursor.execute.call_count)
+
+    def test_get_df_cached_by_database(self):
+        self.cursor.fetchmany.side_effect = [[(1, 'a')], [], [(2, 'b')], []]
+        self.connector.get_dsn_parameters.return_value = {'host': 'prod', 'port': '5439', 'dbname': 'db'}
+        self.redshift.get_df('SELECT * FROM table')
+        # a client of another cluster sharing the cache doesn't get the results of the first one
+        connector = mock.MagicMock()
+        connector.cursor.return_value = self.cursor
+        connector.get_dsn_parameters.return_value = {'host': 'staging', 'port': '5439', 'dbname': 'db'}
+        redshift = RedshiftClient(connector, 'schema', s3_client=None, result_cache=self.redshift.result_cache)
+        df = redshift.get_df('SELECT * FROM table')
+        self.assertSequenceEqual([2], df['col_1'].tolist())
+        self.assertEqual(2, self.cursor.execute.call_count)
+
+    def test_get_df_bypass_cache(self):
+        self.cursor.fetchmany.side_effect = [[(1, 'a')], [], [(1, 'a')], []]
+        self.redshift.get_df('SELECT * FROM table')
+        self.redshift.get_df('SELECT * FROM table', use_cache=False)
+        self.assertEqual(2, self.cursor.execute.call_count)
+
+    def test_get_df_invalidated_by_upsert(self):
+        self.cursor.fetchmany.side_effect = [[(1, 'a')], [], [(2, 'b')], []]
+        self.redshift.get_df('SELECT * FROM table', depends_on=['schema.table'])
+        with mock.patch('pandas_aws.redshift.put_df'):
+            self.redshift._table_columns['table'] = [('col_1', 'integer'), ('col_2', 'varchar(256)')]
+            self.redshift.upsert_rows(pandas.DataFrame({'col_1': [2], 'col_2': ['b']}),
+                                      'table', MY_BUCKET, MY_PREFIX, ['col_1'], 'role')
+        df = self.redshift.get_df('SELECT * FROM table')
+        self.assertSequenceEqual([2], df['col_1'].tolist())
+
+
+class IterDFTests(TestCase):
+    """Test for RedshiftClient.iter_df"""
+
+    def setUp(self):
+        self.connector = mock.MagicMock()
+        self.named_cursor = mock.MagicMock()
+        self.named_cursor.closed = False
+        self.named_cursor.description = [('col_1',), ('col_2',)]
+        self.named_cursor.fetchmany.side_effect = [[(3, 'a'), (2, 'b')], [(1, 'c')], []]
+        self.redshift = RedshiftClient(self.connector, 'schema', s3_client=None)
+        self.connector.cursor.return_value = self.named_cursor
+
+    def test_iter_df_success(self):
+        chunks = list(self.redshift.iter_df('SELECT * FROM table', chunksize=2))
+        self.assertEqual([2, 1], [len(c) for c in chunks])
+        self.assertSequenceEqual(['col_1', 'col_2'], list(chunks[0].columns))
+        self.assertIn('name', self.connector.cursor.call_args.kwargs)
+        self.assertEqual(2, self.named_cursor.itersize)
+        self.named_cursor.close.assert_called_once()
+        self.connector.commit.assert_called_once()
+
+    def test_iter_df_success_closed_early(self):
+        chunks = self.redshift.iter_df('SELECT * FROM table', chunksize=2, output='arrow')
+        self.assertIsInstance(next(chunks), pyarrow.Table)
+        chunks.close()
+        self.named_cursor.close.assert_called_once()
+
+    def test_iter_df_failure(self):
+        self.named_cursor.execute.side_effect = ValueError('invalid query')
+        with self.assertRaises(ValueError):
+            _ = list(self.redshift.iter_df('SELECT * FROM table'))
+        self.connector.rollback.assert_called_once()
+
+
+class StreamWriterTests(BaseAWSTest):
+    """Test for RedshiftClient.stream_writer"""
+
+    def setUp(self):
+        super(StreamWriterTests, self).setUp()
+        self.connector = mock.MagicMock()
+        self.redshift = RedshiftClient(self.connector, 'schema', s3_client=None)
+        self.redshift.s3_client = self.client
+
+    def tearDown(self):
+        super(StreamWriterTests, self).tearDown()
+
+    def copy_queries(self):
+        return [c.args[0] for c in self.redshift.cursor.execute.call_args_list if 'COPY' in c.args[0]]
+
+    def test_stream_writer_success_row_threshold(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        with self.redshift.stream_writer('table', MY_BUCKET, MY_PREFIX, 'role', max_rows=6, parts=2,
+                                         keep_staging=True) as writer:
+            # the second frame reaches the threshold, the third one is loaded on close
+            for _ in range(3):
+                writer.write(df)
+        queries = self.copy_queries()
+        self.assertEqual(2, len(queries))
+        self.assertIn('MANIFEST', queries[0])
+
+        manifest_key = queries[0].split("FROM 's3://mymockbucket/")[1].split("'")[0]
+        manifest = json.loads(self.client.get_object(Bucket=MY_BUCKET, Key=manifest_key)['Body'].read())
+        self.assertEqual(2, len(manifest['entries']))
+        n_rows = 0
+        for entry in manifest['entries']:
+            key = entry['url'].replace(f's3://{MY_BUCKET}/', '')
+            n_rows += len(pandas.read_csv(self.client.get_object(Bucket=MY_BUCKET, Key=key)['Body'],
+                                          compression='gzip'))
+        self.assertEqual(len(df) * 2, n_rows)
+
+        create_queries = [c.args[0] for c in self.redshift.cursor.execute.call_args_list if 'CREATE TABLE' in c.args[0]]
+        self.assertEqual(1, len(create_queries))
+
+    def test_stream_writer_success_staging_removed(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        with self.redshift.stream_writer('table', MY_BUCKET, MY_PREFIX, 'role', max_rows=6, parts=2) as writer:
+            for _ in range(3):
+                writer.write(df)
+        self.assertEqual(2, len(self.copy_queries()))
+        self.assertNotIn('Contents', self.client.list_objects_v2(Bucket=MY_BUCKET, Prefix=MY_PREFIX))
+
+    def test_stream_writer_success_time_threshold(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        writer = self.redshift.stream_writer('table', MY_BUCKET, MY_PREFIX, 'role', max_seconds=0.1)
+        writer.write(df)
+        time.sleep(0.5)
+        writer.flush()
+        self.assertEqual(1, len(self.copy_queries()))
+        writer.close()
+        self.assertEqual(1, len(self.copy_queries()))
+        with self.assertRaises(ValueError):
+            writer.write(df)
+
+    def test_stream_writer_failure_batch_error_raised(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        copies = []
+
+        def execute(query, *args):
+            if 'COPY' in query:
+                copies.append(query)
+                if len(copies) == 1:
+                    time.sleep(0.3)
+                    raise ValueError('COPY failed')
+
+        self.redshift.cursor.execute.side_effect = execute
+        writer = self.redshift.stream_writer('table', MY_BUCKET, MY_PREFIX, 'role', max_rows=4, max_seconds=0.1,
+                                             max_pending_batches=1)
+        writer.write(df)
+        # the timer sends this frame once the failed batch is done, without losing it
+        writer.write(df.iloc[:2])
+        time.sleep(0.6)
+        self.assertEqual(2, len(copies))
+        with self.assertRaises(ValueError) as context:
+            writer.close()
+        self.assertTrue(writer.closed)
+        # the rows of the failed batch come with its error, to be written again
+        pandas.testing.assert_frame_equal(df, context.exception.df)
+        # the staged files of the failed batch are kept, those of the loaded one removed
+        keys = [o['Key'] for o in self.client.list_objects_v2(Bucket=MY_BUCKET, Prefix=MY_PREFIX)['Contents']]
+        self.assertEqual(2, len(keys))
+
+    def test_stream_writer_failure_unexpected_argument(self):
+        with self.assertRaises(TypeError):
+            _ = self.redshift.stream_writer('table', MY_BUCKET, MY_PREFIX, 'role', unknown=True)
+
+
+class UpsertRowsTests(BaseAWSTest):
+    """Test for RedshiftClient.upsert_rows"""
+
+    def setUp(self):
+        super(UpsertRowsTests, self).setUp()
+        self.connector = mock.MagicMock()
+        self.redshift = RedshiftClient(self.connector, 'schema', s3_client=None)
+        self.redshift.s3_client = self.client
+
+    def tearDown(self):
+        super(UpsertRowsTests, self).tearDown()
+
+    def staged_rows(self):
+        keys = [o['Key'] for o in self.client.list_objects_v2(Bucket=MY_BUCKET, Prefix=MY_PREFIX)['Contents']]
+        last_key = sorted(keys, key=lambda k: self.client.head_object(Bucket=MY_BUCKET, Key=k)['LastModified'])[-1]
+        return pandas.read_csv(self.client.get_object(Bucket=MY_BUCKET, Key=last_key)['Body'], compression='gzip')
+
+    def test_upsert_rows_success(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        self.redshift.upsert_rows(df, 'table', MY_BUCKET, MY_PREFIX, ['col_1'], 'role')
+        self.assertEqual(len(df), len(self.staged_rows()))
+
+    def test_upsert_rows_success_with_local_change_detection(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        self.redshift.upsert_rows(df, 'table', MY_BUCKET, MY_PREFIX, ['col_1'], 'role', change_detection='local')
+        n_queries = self.redshift.cursor.execute.call_count
+
+        # unchanged rows are not sent again
+        self.redshift.upsert_rows(df, 'table', MY_BUCKET, MY_PREFIX, ['col_1'], 'role', change_detection='local')
+        self.assertEqual(n_queries, self.redshift.cursor.execute.call_count)
+
+        df.loc[1, 'col_2'] = 'z'
+        df.loc[4] = [4, 'e']
+        self.redshift.upsert_rows(df, 'table', MY_BUCKET, MY_PREFIX, ['col_1'], 'role', change_detection='local')
+        staged = self.staged_rows()
+        self.assertSequenceEqual([2, 4], staged['col_1'].tolist())
+        self.assertSequenceEqual(['z', 'e'], staged['col_2'].tolist())
+
+    def test_upsert_rows_success_with_redshift_change_detection(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        self.redshift.cursor.description = [('col_1',), ('row_hash',)]
+        self.redshift.cursor.fetchmany.return_value = []
+        self.redshift.upsert_rows(df, 'table', MY_BUCKET, MY_PREFIX, ['col_1'], 'role', change_detection='redshift')
+        queries = [c.args[0] for c in self.redshift.cursor.execute.call_args_list]
+        self.assertTrue(any('CREATE TABLE IF NOT EXISTS table_row_hashes' in q for q in queries))
+        self.assertTrue(any('INSERT INTO table_row_hashes' in q for q in queries))
+
+    def test_upsert_rows_success_with_redshift_change_detection_uncached(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        self.redshift.result_cache = mock.MagicMock()
+        self.redshift.cursor.description = [('col_1',), ('row_hash',)]
+        self.redshift.cursor.fetchmany.return_value = []
+        self.redshift.upsert_rows(df, 'table', MY_BUCKET, MY_PREFIX, ['col_1'], 'role', change_detection='redshift')
+        self.redshift.result_cache.get.assert_not_called()
+
+
+class TableMetadataTests(TestCase):
+    """Test for RedshiftClient metadata cache"""
+
+    def setUp(self):
+        self.connector = mock.MagicMock()
+        self.redshift = RedshiftClient(self.connector, 'schema', s3_client=None)
+        self.cursor = self.redshift.cursor
+        self.cursor.fetchall.return_value = [('col_1', 'integer', False, 0),
+                                             ('col_2', 'character varying(256)', False, 0),
+                                             ('date_insert', 'timestamp without time zone', False, 0)]
+        self.df = pandas.DataFrame({'col_1': [3, 2, 1, 0], 'col_2': ['a', 'b', 'c', 'd']})
+
+    def queries(self):
+        return [c.args[0] for c in self.cursor.execute.call_args_list]
+
+    def test_validate_column_names_failure_reserved_word(self):
+        with self.assertRaises(ValueError):
+            self.redshift._validate_column_names(pandas.DataFrame({'Select': [1]}))
+        self.redshift.add_reserved_words(['Col_1'])
+        with self.assertRaises(ValueError):
+            self.redshift._validate_column_names(self.df)
+
+    def test_create_redshift_table_skipped_for_known_table(self):
+        for _ in range(2):
+            self.redshift._create_redshift_table(self.df, 'schema.table')
+        queries = self.queries()
+        self.assertEqual(1, len([q for q in queries if 'pg_attribute' in q]))
+        self.assertEqual(0, len([q for q in queries if 'CREATE TABLE' in q]))
+
+    def test_create_redshift_table_once_for_new_table(self):
+        self.cursor.fetchall.return_value = []
+        for _ in range(2):
+            self.redshift._create_redshift_table(self.df, 'schema.table')
+        self.assertEqual(1, len([q for q in self.queries() if 'CREATE TABLE' in q]))
+
+        self.redshift.invalidate_table_metadata('schema.table')
+        self.redshift._create_redshift_table(self.df, 'schema.table')
+        self.assertEqual(2, len([q for q in self.queries() if 'pg_attribute' in q]))
+
+    def test_create_temp_table_from_keyed_target(self):
+        self.cursor.fetchall.return_value = [('col_1', 'integer', True, 1),
+                                             ('col_2', 'character varying(256)', False, 0),
+                                             ('date_insert', 'timestamp without time zone', False, 0)]
+        self.redshift._create_temp_redshift_table_from_target('table')
+        queries = self.queries()
+        self.assertIn('CREATE TEMP TABLE stage_table (LIKE table)', queries)
+        self.assertIn('ALTER TABLE stage_table DROP COLUMN date_insert;', queries)
+
+    def test_create_temp_table_from_known_target(self):
+        for _ in range(2):
+            self.redshift._create_temp_redshift_table_from_target('table')
+            self.redshift._insert_target_redshift_table_line('stage_table', 'table')
+        queries = self.queries()
+        self.assertIn('CREATE TEMP TABLE stage_table (col_1 integer, col_2 character varying(256))', queries)
+        self.assertEqual(0, len([q for q in queries if 'ALTER TABLE' in q or 'DROP TABLE IF EXISTS' in q]))
+
+
+class StandInTests(BaseAWSTest):
+    """Test for RedshiftClient load paths, against the sqlite stand-in of Redshift"""
+
+    def setUp(self):
+        super(StandInTests, self).setUp()
+        self.connector = StandInConnector(self.client)
+        self.redshift = RedshiftClient(self.connector, 'schema', s3_client=self.client)
+        self.df = pandas.DataFrame({'col_1': [3, 2, 1, 0], 'col_2': ['a', 'b', 'c', None], 'col_3': [.5, 1., 2., 4.]})
+
+    def tearDown(self):
+        self.connector.close()
+        super(StandInTests, self).tearDown()
+
+    def rows(self, table_name: str = 'schema.events') -> list:
+        df = self.redshift.get_df(f'SELECT col_1, col_2, col_3 FROM {table_name} ORDER BY col_1')
+        return list(df.itertuples(index=False, name=None))
+
+    def test_upload_to_redshift_success(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        self.assertSequenceEqual([(0, None, 4.), (1, 'c', 2.), (2, 'b', 1.), (3, 'a', .5)], self.rows())
+        self.assertEqual({'catalog': 1, 'ddl': 1, 'copy': 1, 'select': 1}, dict(self.connector.counts))
+
+        # the table is known, it is neither looked up nor created again
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        self.assertEqual(8, len(self.rows()))
+        self.assertEqual({'catalog': 1, 'ddl': 1, 'copy': 2, 'select': 2}, dict(self.connector.counts))
+
+    def test_upload_to_redshift_success_staging_removed(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        self.assertNotIn('Contents', self.client.list_objects_v2(Bucket=MY_BUCKET, Prefix=MY_PREFIX))
+
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role', keep_staging=True)
+        self.assertEqual(1, len(self.client.list_objects_v2(Bucket=MY_BUCKET, Prefix=MY_PREFIX)['Contents']))
+
+    def test_upload_to_redshift_failure_staging_kept(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        # the copy into a missing column fails, the staged file is kept for investigation
+        with self.assertRaises(Exception):
+            self.redshift.upload_to_redshift(self.df.rename(columns={'col_3': 'col_4'}), 'events',
+                                             MY_BUCKET, MY_PREFIX, 'role')
+        self.assertEqual(1, len(self.client.list_objects_v2(Bucket=MY_BUCKET, Prefix=MY_PREFIX)['Contents']))
+
+    def test_upload_to_redshift_failure_upload_keeps_dropped_table(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        with mock.patch('pandas_aws.redshift.put_df', side_effect=IOError('upload failed')):
+            with self.assertRaises(IOError):
+                self.redshift.upload_to_redshift(self.df.assign(col_4=1), 'events', MY_BUCKET, MY_PREFIX, 'role',
+                                                 drop_table=True)
+        self.assertEqual(4, len(self.rows()))
+        # the table metadata is the one of the restored table
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        self.assertEqual(8, len(self.rows()))
+
+    def test_upload_to_redshift_success_drop_table_during_upload(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        self.connector.reset_stats()
+        ddl_counts = []
+
+        def put_df(*args, **kwargs):
+            # the upload is long enough for the DDL statements to be sent meanwhile
+            deadline = time.monotonic() + 5
+            while self.connector.counts['ddl'] < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            ddl_counts.append(self.connector.counts['ddl'])
+            return pandas_aws.s3.put_df(*args, **kwargs)
+
+        with mock.patch('pandas_aws.redshift.put_df', side_effect=put_df):
+            self.redshift.upload_to_redshift(self.df.iloc[:2], 'events', MY_BUCKET, MY_PREFIX, 'role', drop_table=True)
+        self.assertEqual([2], ddl_counts)
+        self.assertSequenceEqual([(2, 'b', 1.), (3, 'a', .5)], self.rows())
+
+    def test_upsert_rows_success_after_table_reload(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        self.redshift.upsert_rows(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, ['col_1'], 'role')
+
+        # the table is known by its qualified and unqualified names, both are forgotten with the drop
+        df = self.df.assign(col_4=['w', 'x', 'y', 'z'])
+        self.redshift.upload_to_redshift(df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role', drop_table=True)
+        self.redshift.upsert_rows(df.iloc[:1].assign(col_4='v'), 'events', MY_BUCKET, MY_PREFIX, ['col_1'], 'role')
+        df = self.redshift.get_df('SELECT col_1, col_4 FROM schema.events ORDER BY col_1')
+        self.assertSequenceEqual(['z', 'y', 'x', 'v'], df['col_4'].tolist())
+
+    def test_upsert_rows_success(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        self.connector.reset_stats()
+        update_df = pandas.DataFrame({'col_1': [1, 7], 'col_2': ['z', 'y'], 'col_3': [0., 1.]})
+        self.redshift.upsert_rows(update_df, 'events', MY_BUCKET, MY_PREFIX, ['col_1'], 'role')
+        self.assertSequenceEqual([(0, None, 4.), (1, 'z', 0.), (2, 'b', 1.), (3, 'a', .5), (7, 'y', 1.)], self.rows())
+        self.assertEqual(1, self.connector.counts['delete'])
+        self.assertEqual(1, self.connector.counts['insert'])
+
+        # the staging table is dropped with the insert
+        self.redshift.upsert_rows(update_df, 'events', MY_BUCKET, MY_PREFIX, ['col_1'], 'role')
+        self.assertEqual(5, len(self.rows()))
+
+    def test_upsert_rows_success_with_clients_sharing_connection(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        # a staging table left in the session by a client, i.e. by a failed upsert, is dropped by the others
+        self.redshift._create_temp_redshift_table_from_target('events')
+        other = RedshiftClient(self.connector, 'schema', s3_client=self.client)
+        update_df = pandas.DataFrame({'col_1': [1, 7], 'col_2': ['z', 'y'], 'col_3': [0., 1.]})
+        other.upsert_rows(update_df, 'events', MY_BUCKET, MY_PREFIX, ['col_1'], 'role')
+        self.assertSequenceEqual([(0, None, 4.), (1, 'z', 0.), (2, 'b', 1.), (3, 'a', .5), (7, 'y', 1.)], self.rows())
+
+        # a new connection has its own session
+        connector = StandInConnector(self.client)
+        self.addCleanup(connector.close)
+        self.assertEqual(set(), RedshiftClient(connector, 'schema', s3_client=self.client)._staging_tables)
+
+    def test_upsert_rows_success_with_redshift_change_detection_duplicated_keys(self):
+        self.redshift.upload_to_redshift(self.df.copy(), 'events', MY_BUCKET, MY_PREFIX, 'role')
+        df = pandas.concat([self.df, self.df.iloc[:1].assign(col_2='x')], ignore_index=True)
+        self.redshift.upsert_rows(df, 'events', MY_BUCKET, MY_PREFIX, ['col_1'], 'role', change_detection='redshift')
+        hashes = self.redshift.get_df('SELECT col_1, row_hash FROM events_row_hashes')
+        self.assertEqual(4, len(hashes))
+
+        # tables polluted by previous versions hold keys more than once
+        self.redshift.cursor.execute('INSERT INTO events_row_hashes (col_1, row_hash) '
+                                     'SELECT col_1, row_hash + 1 FROM events_row_hashes')
+        self.connector.commit()
+        redshift = RedshiftClient(self.connector, 'schema', s3_client=self.client)
+        redshift.upsert_rows(df, 'events', MY_BUCKET, MY_PREFIX, ['col_1'], 'role', change_detection='redshift')
+        hashes = redshift.get_df('SELECT col_1, row_hash FROM events_row_hashes')
+        self.assertEqual(4, len(hashes[~hashes['col_1'].duplicated()]))
+
+    def test_upsert_rows_success_with_change_detection_key_only(self):
+        df = self.df[['col_1']]
+        for change_detection in ['local', 'redshift']:
+            self.redshift.upload_to_redshift(df.iloc[:0], f'keys_{change_detection}', MY_BUCKET, MY_PREFIX, 'role')
+            self.redshift.upsert_rows(df, f'keys_{change_detection}', MY_BUCKET, MY_PREFIX, ['col_1'], 'role',
+                                      change_detection=change_detection)
+            self.connector.reset_stats()
+            # known keys are unchanged rows
+            self.redshift.upsert_rows(df.assign(col_1=[3, 2, 1, 9]), f'keys_{change_detection}', MY_BUCKET, MY_PREFIX,
+                                      ['col_1'], 'role', change_detection=change_detection)
+            rows = self.redshift.get_df(f'SELECT col_1 FROM keys_{change_detection} ORDER BY col_1')
+            self.assertSequenceEqual([0, 1, 2, 3, 9], rows['col_1'].tolist())
+            # the new key only, and its hash in the side table
+            self.assertEqual(1 if change_detection == 'local' else 2, self.connector.counts['insert'])
+
+    def test_stream_writer_success(self):
+        with self.redshift.stream_writer('events', MY_BUCKET, MY_PREFIX, 'role', parts=2) as writer:
+            writer.write(self.df)
+            writer.write(self.df)
+        self.assertEqual(8, len(self.rows()))
+        self.assertEqual(1, self.connector.counts['copy'])
+
@@ -1,18 +1,28 @@
 #  -*- coding: utf-8 -*-
 __author__ = 'fpajot'
 
+import gzip
 import io
 import logging
+import os
 import pickle
+import tempfile
+import time
+import zipfile
 from unittest import TestCase
 
 import boto3
 from botocore.exceptions import ClientError
+import mock
 from moto import mock_s3
 import pandas
 import numpy
+import pyarrow
+import pyarrow.feather
+import pyarrow.parquet
 
-from pandas_aws.s3 import get_keys, put_df, get_df, get_df_from_keys
+from pandas_aws.s3 import get_keys, put_df, get_df, get_df_from_keys, _concat_arrow_to_df
+from pandas_aws.transfer import TransferScheduler
 
 MY_BUCKET = "mymockbucket"
 MY_PREFIX = "mockfolder"
@@ -67,6 +77,10 @@ class GetKeysTests(BaseAWSTest):
         with self.assertRaises(StopIteration):
             _ = next(get_keys(self.client, MY_BUCKET, prefix='foo'))
 
+    def test_get_s3_keys_failure_deadline_exceeded(self):
+        with self.assertRaises(TimeoutError):
+            _ = next(get_keys(self.client, MY_BUCKET, deadline=time.monotonic() - 1))
+
     def test_get_s3_keys_success_multi_pages(self):
 
         keys = get_keys(self.client, MY_BUCKET, MaxKeys=1)
@@ -114,6 +128,30 @@ class PutDFTests(BaseAWSTest):
         self.assertSequenceEqual(list(o.columns), list(body.columns))
         self.assertSequenceEqual(o.iloc[0].tolist(), body.iloc[0].tolist())
 
+    def test_put_df_success_dataframe_to_pickle_with_out_of_band_buffers(self):
+        o = pandas.DataFrame({'col_1': numpy.arange(1000), 'col_2': numpy.arange(1000) * 0.5})
+        key = MY_PREFIX + '/key1.pickle'
+        put_df(self.client, o, MY_BUCKET, key, format='pickle', out_of_band=True)
+        body = self.client.get_object(Bucket=MY_BUCKET, Key=key)['Body'].read()
+        if pickle.HIGHEST_PROTOCOL >= 5:
+            self.assertTrue(body.endswith(b'PDAWSOOB'))
+        s3_o = get_df(self.client, MY_BUCKET, key, format='pickle')
+        self.assertTrue(o.equals(s3_o))
+        # arrays are built on top of the downloaded buffer, and stay writable
+        s3_o.loc[0, 'col_1'] = 10
+        self.assertEqual(10, s3_o.loc[0, 'col_1'])
+
+    def test_put_df_success_dataframe_to_compressed_pickle_with_out_of_band_buffers(self):
+        o = pandas.DataFrame({'col_1': numpy.arange(1000), 'col_2': numpy.arange(1000) * 0.5})
+        for compression in ['gzip', 'zstd', 'snappy']:
+            key = f'{MY_PREFIX}/key1.pickle.{compression}'
+            put_df(self.client, o, MY_BUCKET, key, format='pickle', compression=compression, out_of_band=True)
+            s3_o = get_df(self.client, MY_BUCKET, key, format='pickle', compression=compression)
+            self.assertTrue(o.equals(s3_o))
+            # decompressed buffers are writable
+            s3_o.loc[0, 'col_1'] = 10
+            self.assertEqual(10, s3_o.loc[0, 'col_1'])
+
     def test_put_df_success_dataframe_to_csv(self):
         o = pandas.DataFrame.from_dict(self.data)
         key = MY_PREFIX + '/key1.csv'
@@ -122,6 +160,58 @@ class PutDFTests(BaseAWSTest):
         self.assertSequenceEqual(list(o.columns), list(body.columns))
         self.assertSequenceEqual(o.iloc[0].tolist(), body.iloc[0].tolist())
 
+    def test_put_df_success_dataframe_to_excel_with_sheet_split(self):
+        o = pandas.DataFrame({'col_1': [3, 2, None, 0, 1], 'col_2': ['a', 'b', 'c', None, 'e'],
+                              'col_3': pandas.date_range('2020-01-01', periods=5)})
+        key = MY_PREFIX + '/key1.xlsx'
+        for constant_memory in [False, True]:
+            put_df(self.client, o, MY_BUCKET, key, format='xlsx', max_rows_per_sheet=3, constant_memory=constant_memory)
+            response = self.client.get_object(Bucket=MY_BUCKET, Key=key)
+            self.assertEqual('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                             response['ContentType'])
+            sheets = pandas.read_excel(io.BytesIO(response['Body'].read()), sheet_name=None)
+            self.assertSequenceEqual(['Sheet1', 'Sheet1_2', 'Sheet1_3'], list(sheets.keys()))
+            self.assertSequenceEqual([2, 2, 1], [len(s) for s in sheets.values()])
+            body = get_df(self.client, MY_BUCKET, key, format='xlsx', sheet_name=None)
+            pandas.testing.assert_frame_equal(o, body, check_dtype=False)
+
+    def test_put_df_success_dataframe_to_excel_with_options(self):
+        o = pandas.DataFrame({'col_1': [1.234, None, 3.456, numpy.inf, -numpy.inf], 'col_2': ['a', None, 'c', 'd', 'e'],
+                              'col_3': [1, 2, 3, 4, 5]})
+        key = MY_PREFIX + '/key1.xlsx'
+        for constant_memory in [False, True]:
+            put_df(self.client, o, MY_BUCKET, key, format='xlsx', na_rep='missing', float_format='%.1f',
+                   columns=['col_1', 'col_2'], header=['first', 'second'], startrow=1, startcol=2,
+                   freeze_panes=(2, 0), max_rows_per_sheet=4, constant_memory=constant_memory)
+            body = get_df(self.client, MY_BUCKET, key, format='xlsx', sheet_name=None, skiprows=1, usecols='C:D')
+            self.assertSequenceEqual(['first', 'second'], list(body.columns))
+            self.assertSequenceEqual([1.2, 'missing', 3.5, numpy.inf, -numpy.inf], body['first'].tolist())
+            self.assertSequenceEqual(['a', 'missing', 'c', 'd', 'e'], body['second'].tolist())
+            with zipfile.ZipFile(io.BytesIO(self.client.get_object(Bucket=MY_BUCKET, Key=key)['Body'].read())) as f:
+                sheets = [f.read(f'xl/worksheets/sheet{i}.xml') for i in range(1, 4)]
+            self.assertTrue(all(b'<pane ySplit="2" topLeftCell="A3"' in sheet for sheet in sheets))
+
+    def test_put_df_success_dataframe_to_excel_with_inf(self):
+        o = pandas.DataFrame({'col_1': [1.5, numpy.inf, -numpy.inf, 2.5]})
+        key = MY_PREFIX + '/key1.xlsx'
+        for constant_memory in [False, True]:
+            put_df(self.client, o, MY_BUCKET, key, format='xlsx', constant_memory=constant_memory)
+            body = get_df(self.client, MY_BUCKET, key, format='xlsx')
+            pandas.testing.assert_frame_equal(o, body)
+
+    def test_put_df_success_dataframe_to_excel_with_to_excel_arguments(self):
+        o = pandas.DataFrame.from_dict(self.data)
+        key = MY_PREFIX + '/key1.xlsx'
+        put_df(self.client, o, MY_BUCKET, key, format='xlsx', merge_cells=False, inf_rep='infinity')
+        body = get_df(self.client, MY_BUCKET, key, format='xlsx')
+        self.assertSequenceEqual(list(o.columns), list(body.columns))
+
+    def test_put_df_failure_dataframe_to_excel_unsupported_argument(self):
+        o = pandas.DataFrame.from_dict(self.data)
+        with self.assertRaises(TypeError):
+            put_df(self.client, o, MY_BUCKET, MY_PREFIX + '/key1.xlsx', format='xlsx', merge_cells=False,
+                   constant_memory=True)
+
     def test_put_df_success_dataframe_to_parquet(self):
         o = pandas.DataFrame.from_dict(self.data)
         key = MY_PREFIX + '/key1.parquet'
@@ -182,6 +272,76 @@ class PutDFTests(BaseAWSTest):
         sorted_o = o.sort_values(sort_keys).reset_index(drop=True)
         self.assertTrue(sorted_o.equals(pandas.concat([body_1, body_2]).reset_index(drop=True)))
 
+    def test_put_df_success_dataframe_with_hash_partition_to_multiple_csv(self):
+        o = pandas.DataFrame({'col_1': numpy.arange(100) % 7, 'col_2': numpy.arange(100)[::-1]})
+        key = MY_PREFIX + '/key1.csv'
+        keys = put_df(self.client, o, MY_BUCKET, key, format='csv', parts=3,
+                      hash_partition_by=['col_1'], sort_keys=['col_2'])
+        self.assertEqual(3, len(keys))
+        bodies = [pandas.read_csv(self.client.get_object(Bucket=MY_BUCKET, Key=k)['Body']) for k in keys]
+        # each key value is written to a single part
+        self.assertEqual(7, sum(b['col_1'].nunique() for b in bodies))
+        self.assertTrue(all(b['col_2'].is_monotonic_increasing for b in bodies))
+        body = pandas.concat(bodies).sort_values('col_2', ascending=False).reset_index(drop=True)
+        self.assertTrue(o.equals(body))
+        # the same key values are written to the same parts
+        keys = put_df(self.client, o.iloc[::-1], MY_BUCKET, MY_PREFIX + '/key2.csv', format='csv', parts=3,
+                      hash_partition_by=['col_1'])
+        other_bodies = [pandas.read_csv(self.client.get_object(Bucket=MY_BUCKET, Key=k)['Body']) for k in keys]
+        for b, other_b in zip(bodies, other_bodies):
+            self.assertSetEqual(set(b['col_1']), set(other_b['col_1']))
+
+    def test_put_df_success_dataframe_with_target_part_bytes(self):
+        o = pandas.DataFrame({'col_1': numpy.arange(20000), 'col_2': numpy.arange(20000) * 0.5})
+        size = len(o.to_csv(index=False).encode('utf-8'))
+        keys = put_df(self.client, o, MY_BUCKET, MY_PREFIX + '/key1.csv', format='csv', target_part_bytes=size // 4)
+        self.assertIn(len(keys), [4, 5])
+        sizes = [self.client.head_object(Bucket=MY_BUCKET, Key=k)['ContentLength'] for k in keys]
+        self.assertLess(max(sizes), size // 4 * 1.1)
+        keys = put_df(self.client, o, MY_BUCKET, MY_PREFIX + '/key1.csv.gz', format='csv', compression='gzip',
+                      target_part_bytes=size)
+        self.assertSequenceEqual([MY_PREFIX + '/key1.csv.gz'], keys)
+
+    def test_put_df_success_dataframe_to_csv_with_fast_compressions(self):
+        o = pandas.DataFrame.from_dict(self.data)
+        for compression in ['zstd', 'lz4', 'snappy']:
+            key = MY_PREFIX + f'/key1.csv.{compression}'
+            put_df(self.client, o, MY_BUCKET, key, compression=compression, compression_level=1)
+            object_ = self.client.get_object(Bucket=MY_BUCKET, Key=key)
+            self.assertEqual(compression, object_['ContentEncoding'].split(',')[0])
+            body = get_df(self.client, MY_BUCKET, key, format='csv')
+            self.assertTrue(o.equals(body))
+
+    def test_put_df_success_dataframe_to_pickle_with_compression(self):
+        o = pandas.DataFrame.from_dict(self.data)
+        key = MY_PREFIX + '/key1.pickle.zst'
+        put_df(self.client, o, MY_BUCKET, key, format='pickle', compression='zstd')
+        body = get_df(self.client, MY_BUCKET, key, format='pickle')
+        self.assertTrue(o.equals(body))
+
+    def test_put_df_success_dataframe_to_parquet_with_compression(self):
+        o = pandas.DataFrame.from_dict(self.data)
+        key = MY_PREFIX + '/key1.parquet'
+        put_df(self.client, o, MY_BUCKET, key, format='parquet', compression='zstd', compression_level=5)
+        parquet_file = pyarrow.parquet.ParquetFile(
+            io.BytesIO(self.client.get_object(Bucket=MY_BUCKET, Key=key)['Body'].read()))
+        self.assertEqual('ZSTD', parquet_file.metadata.row_group(0).column(0).compression)
+
+    def test_put_df_success_dataframe_to_feather(self):
+        o = pandas.DataFrame.from_dict(self.data)
+        for compression in [None, 'lz4']:
+            key = MY_PREFIX + '/key1.feather'
+            put_df(self.client, o, MY_BUCKET, key, format='feather', compression=compression)
+            body = pyarrow.feather.read_table(
+                pyarrow.BufferReader(self.client.get_object(Bucket=MY_BUCKET, Key=key)['Body'].read()))
+            self.assertTrue(o.equals(body.to_pandas()))
+
+    def test_put_df_failure_unknown_compression(self):
+        o = pandas.DataFrame.from_dict(self.data)
+        with self.assertRaises(AssertionError):
+            put_df(self.client, o, MY_BUCKET, MY_PREFIX + '/key1.csv', compression='zip')
+
+
 class GetDFTests(BaseAWSTest):
     """Test for s3.get_df"""
 
@@ -236,6 +396,168 @@ class GetDFTests(BaseAWSTest):
         self.assertSequenceEqual(list(o.columns), list(df.columns))
         self.assertSequenceEqual(o.iloc[0].tolist(), df.iloc[0].tolist())
 
+    def test_get_df_success_with_parquet_type_to_arrow(self):
+        buffer = io.BytesIO()
+        df = pandas.DataFrame.from_dict(self.data)
+        df.to_parquet(buffer, engine='pyarrow')
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.parquet', Body=buffer.getvalue())
+        o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.parquet', format='parquet', output='arrow')
+        self.assertIsInstance(o, pyarrow.Table)
+        self.assertTrue(df.equals(o.to_pandas()))
+
+    def test_get_df_success_with_csv_type_to_arrow(self):
+        buffer = io.StringIO()
+        df = pandas.DataFrame.from_dict(self.data)
+        df.to_csv(buffer, index=False)
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv', Body=buffer.getvalue())
+        o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.csv', format='csv', output='arrow')
+        self.assertIsInstance(o, pyarrow.Table)
+        self.assertSequenceEqual(list(df.columns), o.column_names)
+        self.assertSequenceEqual(self.data['col_1'], o.column('col_1').to_pylist())
+
+    def test_get_df_success_with_byte_ranges(self):
+        buffer = io.BytesIO()
+        df = pandas.DataFrame({'col_1': numpy.arange(1000), 'col_2': numpy.arange(1000) * 0.5})
+        df.to_parquet(buffer, engine='pyarrow')
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.parquet', Body=buffer.getvalue())
+        with mock.patch.object(self.client, 'get_object', wraps=self.client.get_object) as get_object:
+            o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.parquet', format='parquet',
+                       download_chunk_size=1024, download_concurrency=4)
+        self.assertEqual(-(-len(buffer.getvalue()) // 1024), get_object.call_count)
+        self.assertTrue(df.equals(o))
+
+    def test_get_df_success_with_feather_type_and_local_path(self):
+        df = pandas.DataFrame({'col_1': numpy.arange(1000), 'col_2': numpy.arange(1000) * 0.5})
+        buffer = io.BytesIO()
+        pyarrow.feather.write_feather(df, buffer, compression='uncompressed')
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.feather', Body=buffer.getvalue())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_path = os.path.join(tmp_dir, 'key1.feather')
+            o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.feather', format='feather',
+                       local_path=local_path, download_chunk_size=1024)
+            self.assertEqual(len(buffer.getvalue()), os.path.getsize(local_path))
+            self.assertTrue(df.equals(o))
+            table = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.feather', format='feather',
+                           local_path=local_path, output='arrow')
+            self.assertSequenceEqual(list(df.columns), table.column_names)
+
+    def test_get_df_success_with_local_path_reused(self):
+        dfs = [pandas.DataFrame({'col_1': numpy.arange(n) * (i + 1)}) for i, n in enumerate([1000, 10])]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_path = os.path.join(tmp_dir, 'key1.feather')
+            tables = []
+            for i, df in enumerate(dfs):
+                buffer = io.BytesIO()
+                pyarrow.feather.write_feather(df, buffer, compression='uncompressed')
+                self.client.put_object(Bucket=MY_BUCKET, Key=f'{MY_PREFIX}/key{i}.feather', Body=buffer.getvalue())
+                tables.append(get_df(self.client, MY_BUCKET, f'{MY_PREFIX}/key{i}.feather', format='feather',
+                                     local_path=local_path, output='arrow'))
+            # the first table is still mapped on its own file, not overwritten by the second download
+            self.assertEqual(5, tables[0].column('col_1')[5].as_py())
+            self.assertSequenceEqual(dfs[0]['col_1'].tolist(), tables[0].column('col_1').to_pylist())
+            self.assertEqual(10, tables[1].num_rows)
+            self.assertSequenceEqual(['key1.feather'], os.listdir(tmp_dir))
+
+    def test_get_df_failure_with_local_path_removes_partial_file(self):
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv', Body=b'col_1\n' * 100)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with mock.patch.object(self.client, 'get_object', wraps=self.client.get_object) as get_object:
+                get_object.side_effect = [self.client.get_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv',
+                                                                 Range='bytes=0-9'), IOError('failed')]
+                with self.assertRaises(IOError):
+                    get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.csv', format='csv',
+                           local_path=os.path.join(tmp_dir, 'key1.csv'), download_chunk_size=10,
+                           download_concurrency=1)
+            self.assertSequenceEqual([], os.listdir(tmp_dir))
+
+    def test_get_df_success_with_empty_object(self):
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv', Body=b'')
+        with self.assertRaises(pandas.errors.EmptyDataError):
+            _ = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.csv', format='csv')
+
+    def test_get_df_success_with_compression_from_magic_bytes(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv.gz',
+                               Body=gzip.compress(df.to_csv(index=False).encode('utf-8')))
+        o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.csv.gz', format='csv')
+        self.assertTrue(df.equals(o))
+
+    def test_get_df_success_with_format_detection(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, engine='pyarrow')
+        self.client.put_object(Bucket=MY_BUCKET, Key=f'{MY_PREFIX}/part-0000', Body=buffer.getvalue())
+        o = get_df(self.client, MY_BUCKET, f'{MY_PREFIX}/part-0000', format=None)
+        self.assertTrue(df.equals(o))
+
+    def test_get_df_success_with_pandas_compression(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        for compression in ['bz2', 'xz']:
+            key = f'{MY_PREFIX}/key1.csv.{compression}'
+            buffer = io.BytesIO()
+            df.to_csv(buffer, index=False, compression=compression)
+            self.client.put_object(Bucket=MY_BUCKET, Key=key, Body=buffer.getvalue())
+            o = get_df(self.client, MY_BUCKET, key, format='csv', compression=compression)
+            self.assertTrue(df.equals(o))
+
+    def test_get_df_success_with_throttling(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv', Body=df.to_csv(index=False))
+        slow_down = ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject')
+        scheduler = TransferScheduler(initial_concurrency=4, base_delay=0.001)
+        response = self.client.get_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv')
+        with mock.patch.object(self.client, 'get_object', side_effect=[slow_down, response]) as get_object:
+            o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.csv', format='csv', scheduler=scheduler)
+        self.assertEqual(2, get_object.call_count)
+        self.assertEqual(2, scheduler.concurrency(f'{MY_BUCKET}/{MY_PREFIX}'))
+        self.assertTrue(df.equals(o))
+
+    def test_get_df_success_with_body_read_in_flight(self):
+        df = pandas.DataFrame.from_dict(self.data)
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv', Body=df.to_csv(index=False))
+        scheduler = TransferScheduler(initial_concurrency=4)
+        get_object = self.client.get_object
+        in_flight = []
+
+        def get_object_tracked(**kwargs):
+            response = get_object(**kwargs)
+            read = response['Body'].read
+
+            def read_tracked(*args):
+                in_flight.append(scheduler._get_limit(f'{MY_BUCKET}/{MY_PREFIX}').in_flight)
+                return read(*args)
+            response['Body'].read = read_tracked
+            return response
+        with mock.patch.object(self.client, 'get_object', side_effect=get_object_tracked):
+            o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.csv', format='csv', scheduler=scheduler)
+        self.assertTrue(in_flight)
+        self.assertEqual([1] * len(in_flight), in_flight)
+        self.assertTrue(df.equals(o))
+
+    def test_get_df_success_with_compact_memory_nan(self):
+        df = pandas.DataFrame({'col_1': [0.5, numpy.nan, 1.5], 'col_2': [0.1, numpy.nan, 1.5]})
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv', Body=df.to_csv(index=False))
+        o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.csv', format='csv', memory='compact')
+        self.assertEqual('float32', o['col_1'].dtype)
+        self.assertEqual('float64', o['col_2'].dtype)
+        pandas.testing.assert_frame_equal(df, o.astype({'col_1': 'float64'}))
+
+    def test_get_df_success_with_compact_memory(self):
+        df = pandas.DataFrame({'col_1': numpy.arange(1000), 'col_2': numpy.arange(1000) * 0.5,
+                               'col_3': numpy.array(['a', 'b'])[numpy.arange(1000) % 2],
+                               'col_4': [f'id{i}' for i in range(1000)]})
+        self.client.put_object(Bucket=MY_BUCKET, Key=MY_PREFIX + '/key1.csv', Body=df.to_csv(index=False))
+        with self.assertLogs('pandas_aws.s3', level='INFO') as logs:
+            o = get_df(self.client, MY_BUCKET, MY_PREFIX + '/key1.csv', format='csv', memory='compact')
+        self.assertIn('bytes saved', logs.output[-1])
+        self.assertEqual('int16', o['col_1'].dtype)
+        self.assertEqual('float32', o['col_2'].dtype)
+        self.assertEqual('category', o['col_3'].dtype)
+        self.assertEqual('string', o['col_4'].dtype)
+        self.assertLess(o.memory_usage(deep=True).sum(), df.memory_usage(deep=True).sum())
+        pandas.testing.assert_frame_equal(df, o.astype({'col_1': 'int64', 'col_2': 'float64',
+                                                        'col_3': object, 'col_4': object}))
+
 
 class GetDFFromKeysTests(BaseAWSTest):
     """Test for s3.get_df_from_keys"""
@@ -301,3 +623,84 @@ class GetDFFromKeysTests(BaseAWSTest):
         # check no data
         df = get_df_from_keys(self.client, MY_BUCKET, MY_PREFIX, suffix='egs')
         self.assertEqual(df, None)
+
+    def test_get_df_from_keys_with_mismatched_schemas(self):
+        prefix = 'mismatched'
+        frames = [pandas.DataFrame({'col_1': [1, 2], 'col_2': ['a', 'b']}),
+                  pandas.DataFrame({'col_1': [0.5], 'col_3': [True]})]
+        for i, df in enumerate(frames):
+            buffer = io.BytesIO()
+            df.to_parquet(buffer, engine='pyarrow')
+            self.client.put_object(Bucket=MY_BUCKET, Key=f'{prefix}/key{i}.parquet', Body=buffer.getvalue())
+
+        df = get_df_from_keys(self.client, MY_BUCKET, prefix, format='parquet')
+        self.assertSequenceEqual(['col_1', 'col_2', 'col_3'], list(df.columns))
+        self.assertEqual('float64', df['col_1'].dtype.name)
+        self.assertSequenceEqual([1.0, 2.0, 0.5], df['col_1'].tolist())
+        self.assertTrue(df.loc[2, 'col_2'] is None)
+        self.assertEqual(list(range(3)), list(df.index))
+
+    def test_concat_arrow_to_df_releases_inputs(self):
+        # input buffers must be released while the DataFrame is built, not once it is
+        pool = pyarrow.proxy_memory_pool(pyarrow.default_memory_pool())
+        tables = [pyarrow.table({'col_1': pyarrow.array(list(range(1000)), type=pyarrow.int64(), memory_pool=pool)})
+                  for _ in range(3)]
+        concat_tables = pyarrow.concat_tables
+        allocated = []
+
+        class Table(object):
+            def __init__(self, table):
+                self.table = table
+
+            def to_pandas(self, **kwargs):
+                df = self.table.to_pandas(**kwargs)
+                allocated.append(pool.bytes_allocated())
+                return df
+
+        with mock.patch('pyarrow.concat_tables', side_effect=lambda t: Table(concat_tables(t))):
+            df = _concat_arrow_to_df(tables)
+        self.assertEqual([0], allocated)
+        self.assertEqual([], tables)
+        self.assertEqual(3000, len(df))
+
+    def test_get_df_from_keys_to_arrow_dataset(self):
+        dataset = get_df_from_keys(self.client, MY_BUCKET, MY_PREFIX, suffix='.parquet', output='arrow')
+        table = dataset.to_table()
+        self.assertSequenceEqual(list(self.data.keys()), table.column_names)
+        self.assertEqual(len(self.data['col_1']) * 2, table.num_rows)
+
+    def test_get_df_from_keys_with_compact_memory(self):
+        o = get_df_from_keys(self.client, MY_BUCKET, MY_PREFIX, suffix='.parquet', memory='compact')
+        self.assertEqual('int8', o['col_1'].dtype)
+        self.assertEqual('category', o['col_2'].dtype)
+        self.assertSequenceEqual(self.data['col_2'] * 2, o['col_2'].tolist())
+
+    def test_get_df_from_keys_suffix_format_per_key(self):
+        # formats must be resolved for each key, not only the first one
+        df = get_df_from_keys(self.client, MY_BUCKET, MY_PREFIX, format='suffix')
+        self.assertEqual(len(self.data['col_1']) * 6, df.shape[0])
+
+    def test_get_df_from_keys_mixed_format_downloads_once(self):
+        prefix = 'mixed'
+        df = pandas.DataFrame.from_dict(self.data)
+        self.client.put_object(Bucket=MY_BUCKET, Key=f'{prefix}/key1', Body=pickle.dumps(df))
+        self.client.put_object(Bucket=MY_BUCKET, Key=f'{prefix}/key2',
+                               Body=gzip.compress(df.to_csv(index=False).encode('utf-8')))
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, engine='pyarrow')
+        self.client.put_object(Bucket=MY_BUCKET, Key=f'{prefix}/key3', Body=buffer.getvalue())
+
+        with mock.patch.object(self.client, 'get_object', wraps=self.client.get_object) as get_object:
+            o = get_df_from_keys(self.client, MY_BUCKET, prefix, format='mixed')
+        self.assertEqual(3, get_object.call_count)
+        self.assertSequenceEqual(list(self.data.keys()), list(o.columns))
+        self.assertEqual(len(self.data['col_1']) * 3, o.shape[0])
+
+    def test_get_df_from_keys_listing_shares_deadline(self):
+        # the listing must not start a new timeout, but count against the one of the whole call
+        with mock.patch('pandas_aws.s3.get_keys', wraps=get_keys) as get_keys_, \
+                mock.patch.object(TransferScheduler, 'deadline', return_value=1e12) as deadline:
+            get_df_from_keys(self.client, MY_BUCKET, MY_PREFIX, suffix='.csv', format='csv', timeout=60)
+        deadline.assert_called_once_with(60)
+        self.assertEqual(1e12, get_keys_.call_args[1]['deadline'])
+        self.assertNotIn('timeout', get_keys_.call_args[1])
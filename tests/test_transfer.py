@@ -0,0 +1,75 @@
+#  -*- coding: utf-8 -*-
+__author__ = 'fpajot'
+
+from unittest import TestCase
+
+from botocore.exceptions import ClientError
+import mock
+
+from pandas_aws.transfer import TransferScheduler, is_throttling_error
+
+
+def throttling_error(code='SlowDown'):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject')
+
+
+class TransferSchedulerTests(TestCase):
+    """Test for TransferScheduler"""
+
+    def setUp(self):
+        self.scheduler = TransferScheduler(initial_concurrency=8, max_concurrency=10, base_delay=0.001)
+
+    def test_is_throttling_error(self):
+        self.assertTrue(is_throttling_error(throttling_error()))
+        self.assertFalse(is_throttling_error(ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')))
+        self.assertFalse(is_throttling_error(ValueError()))
+
+    def test_call_additive_increase(self):
+        for _ in range(9):
+            self.assertEqual(1, self.scheduler.call('bucket/prefix', lambda: 1))
+        self.assertEqual(9, self.scheduler.concurrency('bucket/prefix'))
+        for _ in range(100):
+            self.scheduler.call('bucket/prefix', lambda: 1)
+        self.assertEqual(10, self.scheduler.concurrency('bucket/prefix'))
+        self.assertEqual(8, self.scheduler.concurrency('bucket/other_prefix'))
+
+    def test_call_retries_throttled_requests(self):
+        func = mock.Mock(side_effect=[throttling_error(), throttling_error('503'), 'result'])
+        self.assertEqual('result', self.scheduler.call('bucket/prefix', func, 'arg', kwarg='kwarg'))
+        func.assert_called_with('arg', kwarg='kwarg')
+        self.assertEqual(3, func.call_count)
+        # multiplicative decrease at each throttled request
+        self.assertEqual(2, self.scheduler.concurrency('bucket/prefix'))
+
+    def test_call_single_decrease_for_concurrent_requests(self):
+        limit = self.scheduler._get_limit('bucket/prefix')
+        generations = [self.scheduler._acquire(limit, None) for _ in range(4)]
+        for generation in generations:
+            self.scheduler._release(limit, generation, True, False)
+        self.assertEqual(4, self.scheduler.concurrency('bucket/prefix'))
+
+    def test_call_raises_other_errors(self):
+        func = mock.Mock(side_effect=ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject'))
+        with self.assertRaises(ClientError):
+            self.scheduler.call('bucket/prefix', func)
+        self.assertEqual(1, func.call_count)
+        # failed requests don't increase the limit as successful ones
+        for _ in range(16):
+            with self.assertRaises(ClientError):
+                self.scheduler.call('bucket/prefix', func)
+        self.assertEqual(8, self.scheduler.concurrency('bucket/prefix'))
+        self.assertEqual(0, self.scheduler._get_limit('bucket/prefix').in_flight)
+
+    def test_call_max_attempts(self):
+        scheduler = TransferScheduler(max_attempts=3, base_delay=0.001)
+        func = mock.Mock(side_effect=throttling_error())
+        with self.assertRaises(ClientError):
+            scheduler.call('bucket/prefix', func)
+        self.assertEqual(3, func.call_count)
+
+    def test_call_deadline(self):
+        func = mock.Mock(side_effect=throttling_error())
+        with self.assertRaises(TimeoutError):
+            TransferScheduler(base_delay=10).call('bucket/prefix', func, deadline=self.scheduler.deadline(1))
+        with self.assertRaises(TimeoutError):
+            self.scheduler.call('bucket/prefix', func, deadline=self.scheduler.deadline(0))